@@ -27,8 +27,17 @@ import datetime
 import arrow
 import argparse
 import json
+import math
+import heapq
+import random
+import bisect
+import urlparse
+import BaseHTTPServer
+import SocketServer
+import threading
 from dateutil.tz import *
 from collections import namedtuple
+from collections import OrderedDict
 
 FC_AWS_ENV = "AWS_DEFAULT_PROFILE"
 FC_TIME_ZONE = "US/Eastern"
@@ -37,16 +46,51 @@ FC_EBS_STATUS_ATTACHED = 'attached'
 FC_EBS_STATUS_UNATTACHED = 'unattached'
 FC_STAT_DAYS = 14
 FC_STAT_PERIOD = 900 # fifteen minutes in seconds
-FC_NUM_DATAPOINTS = FC_STAT_PERIOD / 300 # number of datapoints in period
+FC_CW_INTERVAL = 300 # seconds between EBS datapoints in CloudWatch
+FC_MAX_STAT_DAYS = 455 # CloudWatch keeps hourly data for 455 days
+# (days ago, period) resolution tiers for lookbacks beyond FC_STAT_DAYS:
+# fifteen-minute periods for the last week, three hours up to 30 days and
+# daily for the rest of the window (None), at most 1,282 datapoints per
+# metric for FC_MAX_STAT_DAYS
+FC_STAT_TIERS = [(7, FC_STAT_PERIOD), (30, 3*3600), (None, 86400)]
 GP2_IOPS_PER_GB = 3
-IO1_IOPS_THRESHOLD = 0.75
+GP3_BASELINE_IOPS = 3000 # included in the gp3 price per GB
+GP3_MAX_IOPS_PER_GB = 500
+IO1_MAX_IOPS_PER_GB = 50
+# volume types supported by this script, and the ones we migrate to
+# (magnetic is previous generation and never recommended)
+FC_VOLUME_TYPES = ['gp2', 'gp3', 'io1', 'st1', 'sc1', 'standard']
+FC_MIGRATION_TYPES = ['gp2', 'gp3', 'io1', 'st1', 'sc1']
+FC_VOLUME_PAGE_SIZE = 500 # largest page allowed by describe_volumes
+FC_DAEMON_MIN_INTERVAL = 300 # five minutes in seconds
+FC_DAEMON_MAX_INTERVAL = 6*3600 # six hours in seconds
+FC_DAEMON_METRIC_TTL = 24*3600 # refresh volume metrics once a day
+FC_DAEMON_METRIC_RATE = 10 # volumes with metric queries per second, all regions
+FC_DAEMON_CHANGE_WEIGHT = 0.5 # weight of latest refresh in change rate
+FC_SERVE_HOST = '127.0.0.1'
+FC_SERVE_DEFAULT_LIMIT = 100 # advisories per page
+FC_SERVE_MAX_LIMIT = 1000
+FC_SAVINGS_BUCKETS = [0, 10, 50, 100, 500, 1000] # monthly savings in dollars
+FC_DEFAULT_REGION = 'us-east-1' # for describe_regions and unknown rates
+FC_REGION_CACHE = os.path.join(os.path.expanduser("~"), ".ebscostanalyzer_regions.json")
+FC_REGION_CACHE_TTL = 24*3600 # one day in seconds
+FC_PROBE_MAX_RESULTS = 5 # smallest page allowed by describe_volumes
+FC_SNAPSHOT_RECENT_DAYS = 30 # snapshots newer than this make deletion safe
+FC_SNAPSHOT_USED_FRACTION = 0.5 # assume volumes are half full
+FC_ROLLUP_MAX_GROUPS = 10000 # groups kept per rollup
+FC_ROLLUP_OTHER = "(other)"
+FC_ROLLUP_NONE = "(none)" # group of volumes without the tag
+FC_SAMPLE_SIZE_BUCKETS = [0, 100, 500, 1000, 4000] # volume sizes in GB
+FC_SAMPLE_MIN_PER_STRATUM = 2 # volumes sampled first in every stratum
+FC_SAMPLE_CONFIDENCE = 0.95
+FC_SAMPLE_Z = 1.96 # normal quantile for FC_SAMPLE_CONFIDENCE
 
 # Iops is max avilable Iops.
 # To get actual IOPS, use the sum of ReadIops and WriteIops.
 EbsInfo = namedtuple("EbsInfo", "VolId VolName Ec2Id Ec2Name Type Size Device AvailabilityZone Iops UsedSize ReadIops WriteIops CreateTime CurrTime State Status DeleteOnTermination Encrypted KmsKeyId FcVol Tags")
 
-# We dynamically update regions in our software, but for the
-# purposes of this script, hardcoding is fine.
+# Regions are discovered with describe_regions during preflight.  This
+# list is only used if that fails or preflight is disabled.
 aws_regions = [
     'us-east-1',       # US East (N. Virginia)
     'us-west-2',       # US West (Oregon)
@@ -146,6 +190,56 @@ ebs_monthly_rates={
         "eu-west-1": 0.028,
         "eu-west-2": 0.029
     },
+    "gp3": {
+        "us-east-1": 0.08,
+        "us-west-1": 0.096,
+        "ap-northeast-2": 0.0912,
+        "us-east-2": 0.08,
+        "ap-northeast-1": 0.096,
+        "eu-west-1": 0.088,
+        "ap-southeast-1": 0.096,
+        "ca-central-1": 0.088,
+        "ap-southeast-2": 0.096,
+        "us-west-2": 0.08,
+        "ap-south-1": 0.0912,
+        "eu-central-1": 0.0952,
+        "sa-east-1": 0.152,
+        "eu-west-2": 0.0928
+    },
+    # gp3 IOPS provisioned above GP3_BASELINE_IOPS
+    "gp3iops": {
+        "us-east-1": 0.005,
+        "us-west-1": 0.006,
+        "ap-northeast-2": 0.0057,
+        "us-east-2": 0.005,
+        "ap-northeast-1": 0.006,
+        "eu-west-1": 0.0055,
+        "ap-southeast-1": 0.006,
+        "ca-central-1": 0.0055,
+        "ap-southeast-2": 0.006,
+        "us-west-2": 0.005,
+        "ap-south-1": 0.0057,
+        "eu-central-1": 0.006,
+        "sa-east-1": 0.0095,
+        "eu-west-2": 0.0058
+    },
+    # snapshot storage per GB-month
+    "snapshot": {
+        "us-east-1": 0.05,
+        "us-west-1": 0.055,
+        "ap-northeast-2": 0.05,
+        "us-east-2": 0.05,
+        "ap-northeast-1": 0.05,
+        "eu-west-1": 0.05,
+        "ap-southeast-1": 0.05,
+        "ca-central-1": 0.055,
+        "ap-southeast-2": 0.055,
+        "us-west-2": 0.05,
+        "ap-south-1": 0.05,
+        "eu-central-1": 0.054,
+        "sa-east-1": 0.068,
+        "eu-west-2": 0.053
+    },
     "gp2": {
         "us-east-1": 0.1,
         "us-west-1": 0.12,
@@ -164,195 +258,301 @@ ebs_monthly_rates={
     }
 }
 
-#
-# Simple roundup function
-#
-def roundup(a):
-    return a if (int(a) == a) else a + 1
+# regions without rates in ebs_monthly_rates that have been warned about
+unknown_rate_regions = []
 
 #
-# Find maximum value in a list of datapoints returned
-# from a call to get_metric_statistics
+# Returns a list of (startTime, endTime, period) tuples covering the last
+# 'lookback' days, most recent first, but not before createTime.  The
+# default FC_STAT_DAYS window is a single FC_STAT_PERIOD window.  Longer
+# lookbacks use coarser periods for older days (see FC_STAT_TIERS), so
+# they need no more datapoints than the default window.
 #
-def find_max(data, field):
-    m = 0
-    for i in range(len(data)):
-        m = max(m, data[i][field])
-    return m
+def get_stat_windows(createTime, lookback):
+    now = arrow.now(FC_TIME_ZONE).replace(second=0, microsecond=0)
+    windowStart = now.replace(days=-lookback, hour=0, minute=0, second=0, microsecond=0)
+    if (arrow.get(createTime) > windowStart):
+        windowStart = arrow.get(createTime)
+
+    tiers = FC_STAT_TIERS
+    if (lookback <= FC_STAT_DAYS):
+        tiers = [(None, FC_STAT_PERIOD)]
+
+    windows = []
+    endTime = now
+    for days, period in tiers:
+        if (days == None):
+            startTime = windowStart
+        else:
+            startTime = max(now.replace(days=-days), windowStart)
+        if (startTime < endTime):
+            windows.append((startTime.format(TIME_FMT), endTime.format(TIME_FMT), period))
+        endTime = startTime
+        if (endTime <= windowStart):
+            break
+    return windows
 
 #
-# returns maximum value for IOPS over 14-day period by default.
-# metricName can be 'VolumeReadOps' or 'VolumeWriteOps'
+# returns maximum values for read and write IOPS over the lookback period,
+# 14 days by default, as a tuple (readIops, writeIops).
 #
-def get_iops(cloudWatch, ebsId, metricName, createTime, useAvg):
-    iops = 0
+def get_volume_iops(cloudWatch, ebsId, createTime, useAvg, lookback=FC_STAT_DAYS):
     startTime = arrow.now(FC_TIME_ZONE).replace(days=-FC_STAT_DAYS, hour=0, minute=0, second=0, microsecond=0).format(TIME_FMT)
-    endTime = arrow.now(FC_TIME_ZONE).format(TIME_FMT)
 
     if ((arrow.get(startTime) - arrow.get(createTime)).days <= FC_STAT_DAYS):
-        return -1 # Younger than 14 days
+        return -1, -1 # Younger than 14 days
 
     if (useAvg == False):
         statistic = 'Maximum'
     else:
         statistic = 'Average'
+
+    # sometimes cloudwatch doesn't save data, no idea why
+    iops = {'VolumeReadOps': -1, 'VolumeWriteOps': -1}
     try:
-        response = cloudWatch.get_metric_statistics(Namespace='AWS/EBS',
-                                            MetricName=metricName,
-                                            Dimensions=[{'Name': 'VolumeId',
-                                                         'Value': ebsId}],
-                                            StartTime=startTime,
-                                            EndTime=endTime,
-                                            Period=FC_STAT_PERIOD,
-                                            Statistics=[statistic],
-                                            Unit='Count')
-        # gp2, st1, and sc1 volumes update CloudWatch every 5 minutes.
-        # Thus, a 5-minute period equals a single datapoint that is the total
-        # number of IOPS during that 5-minute period.  Using only burst IOPS
-        # for gp2, an 8GB gp2 volume could theoretically perform 900,000 IOPS
-        # in a single 5-minute window.  For better accuracy, it's best to use
-        # average IOPS with a 5-minute period determined not by the "Average"
-        # statistic but by taking the value of Maximum or Average statistic
-        # in a time period and dividing it by 300 (seconds per 5 minutes).
-        if (len(response['Datapoints']) == 0):
-            iops = -1 # sometimes cloudwatch doesn't save data, no idea why
-        else:
-            iops = find_max(response['Datapoints'], statistic)/ \
-                   (FC_STAT_PERIOD/FC_NUM_DATAPOINTS)
+        # one request per resolution tier fetches both metrics
+        for startTime, endTime, period in get_stat_windows(createTime, lookback):
+            queries = []
+            for metricName in iops.keys():
+                queries.append({'Id': metricName.lower(),
+                                'MetricStat': {
+                                    'Metric': {'Namespace': 'AWS/EBS',
+                                               'MetricName': metricName,
+                                               'Dimensions': [{'Name': 'VolumeId',
+                                                               'Value': ebsId}]},
+                                    'Period': period,
+                                    'Stat': statistic,
+                                    'Unit': 'Count'},
+                                'ReturnData': True})
+            response = cloudWatch.get_metric_data(MetricDataQueries=queries,
+                                                  StartTime=startTime,
+                                                  EndTime=endTime)
+            # gp2, st1, and sc1 volumes update CloudWatch every 5 minutes.
+            # Thus, a 5-minute period equals a single datapoint that is the total
+            # number of IOPS during that 5-minute period.  Using only burst IOPS
+            # for gp2, an 8GB gp2 volume could theoretically perform 900,000 IOPS
+            # in a single 5-minute window.  For better accuracy, it's best to use
+            # average IOPS with a 5-minute period determined not by the "Average"
+            # statistic but by taking the value of Maximum or Average statistic
+            # in a time period and dividing it by 300 (seconds per 5 minutes).
+            # The Maximum of a coarser period is still the busiest 5-minute
+            # datapoint, so peaks are found at every resolution.
+            for result in response['MetricDataResults']:
+                if (len(result['Values']) == 0):
+                    continue
+                for metricName in iops.keys():
+                    if (result['Id'] == metricName.lower()):
+                        iops[metricName] = max(iops[metricName],
+                                               max(result['Values'])/float(FC_CW_INTERVAL))
     except:
         e = sys.exc_info()
         print("Failed to get volume statistics: %s" %(str(e)))
-        iops = -2
-    return iops
+        return -2, -2
+    return iops['VolumeReadOps'], iops['VolumeWriteOps']
 
 #
-# Queries volumes and puts results into list of EbsInfo structs
-# Requires ec2Connection to describe_volumes and cloudWatch to
-# query statistics
+# Returns True if a volume returned by describe_volumes is attached as a
+# root device.
 #
-def get_ebs_info(ec2Connection, cloudWatch, ebsIdList, useAvg):
-        listOfEbsInfo = [] 
-        ebsInfo = None 
-        count = 0
-        retry = 5
-        while count < retry:
-            count += 1 
-            try:
-                responseVol = ec2Connection.describe_volumes(DryRun=False, VolumeIds=ebsIdList)
-                for volume in responseVol['Volumes']:
-                    # Skip root devices.
-                    # Paravirtual reserves /dev/sda1 for root dev
-                    # HVM could be either /dev/sda1 or /dev/xvda
-                    if (('Attachments' in volume or volume['Attachments']) and
-                        (len(volume['Attachments']) > 0)):
-                        if (volume['Attachments'][0]['Device'] == "/dev/sda1" or
-                            volume['Attachments'][0]['Device'] == "/dev/xvda"):
-                            continue
-
-                    # get EBS tags
-                    volTags = ec2Connection.describe_tags(
-                        Filters=[{'Name': 'resource-id', 'Values': [volume['VolumeId']]}])
-                    utcStr = arrow.now(FC_TIME_ZONE).format(TIME_FMT)
-                    iops = volume['Iops'] if 'Iops' in volume else 0
-                    kmsKeyId = volume['KmsKeyId'] if 'KmsKeyId' in volume else '0'
-                    if cloudWatch:
-                        readIops = get_iops(cloudWatch, volume['VolumeId'], 'VolumeReadOps', arrow.get(volume['CreateTime']).to(FC_TIME_ZONE).format(TIME_FMT), useAvg)
-                        writeIops = get_iops(cloudWatch, volume['VolumeId'], 'VolumeWriteOps', arrow.get(volume['CreateTime']).to(FC_TIME_ZONE).format(TIME_FMT), useAvg)
-
-                    # skip vol on an error
-                    if (readIops == -2 or writeIops == -2):
-                        continue
-
-                    # get volume name if it has one
-                    volName = ""
-                    for tag in volTags['Tags']:
-                        if tag['Key'] == 'Name' and tag['Value']:
-                            volName = tag['Value']
-                            break
-
-                    if (not 'Attachments' in volume or
-                        not volume['Attachments'] or
-                        len(volume['Attachments']) == 0):
-                        ebsInfo = EbsInfo(
-                            VolId       = volume['VolumeId'],
-                            VolName     = volName,
-                            Ec2Id       = "NA",
-                            Ec2Name     = "",
-                            Type        = volume['VolumeType'],
-                            Size        = volume['Size'],
-                            Device      = "NA",
-                            AvailabilityZone = volume['AvailabilityZone'],
-                            Iops        = iops,
-                            UsedSize    = volume['Size'],
-                            ReadIops    = readIops,
-                            WriteIops   = writeIops,
-                            CreateTime  = arrow.get(volume['CreateTime']).to(FC_TIME_ZONE).format(TIME_FMT),
-                            State       = volume['State'],
-                            Status      = FC_EBS_STATUS_UNATTACHED,
-                            DeleteOnTermination = "NA",
-                            CurrTime    = utcStr,
-                            FcVol       = "NA",
-                            Encrypted   = volume['Encrypted'],
-                            KmsKeyId    = kmsKeyId,
-                            Tags        = volTags['Tags'])
-                    else:
-                        # get ec2 instance name if it has one
-                        ec2Tags = ec2Connection.describe_tags(         \
-                            Filters=[{'Name': 'resource-id', 'Values': \
-                                    [volume['Attachments'][0]['InstanceId']]}])
-
-                        ec2Name = ""
-                        for tag in ec2Tags['Tags']:
-                            if tag['Key'] == 'Name' and tag['Value']:
-                                ec2Name = tag['Value']
-                                break
-
-                        ebsInfo = EbsInfo(
-                            VolId       = volume['VolumeId'],
-                            VolName     = volName,
-                            Ec2Id       = volume['Attachments'][0]['InstanceId'],
-                            Ec2Name     = ec2Name,
-                            Type        = volume['VolumeType'],
-                            Size        = volume['Size'],
-                            Device      = volume['Attachments'][0]['Device'],
-                            AvailabilityZone = volume['AvailabilityZone'],
-                            Iops        = iops,
-                            UsedSize    = volume['Size'],
-                            ReadIops    = readIops,
-                            WriteIops   = writeIops,
-                            CreateTime  = arrow.get(volume['CreateTime']).to(FC_TIME_ZONE).format(TIME_FMT),
-                            State       = volume['State'],
-                            Status      = FC_EBS_STATUS_ATTACHED,
-                            DeleteOnTermination = volume['Attachments'][0]['DeleteOnTermination'],
-                            CurrTime    = utcStr,
-                            FcVol       = volume['Attachments'][0]['Device'],
-                            Encrypted   = volume['Encrypted'],
-                            KmsKeyId    = kmsKeyId,
-                            Tags        = volTags['Tags'])
-                    listOfEbsInfo.append(ebsInfo)
-                break
-            except botocore.exceptions.ClientError as e:
-                print("Failed to get ebs volume info, ebsId={0}, %s".format(ebsIdList) %(e.response['Error']['Message']))
-                if e.response['Error']['Code'] == 'Client.RequestLimitExceeded':
-                    print("retry describe_volumes")
-                    time.sleep(24*count)
-                    continue
-                return listOfEbsInfo
-            except:
-                e = sys.exc_info()
-                print("Failed to get ebs volume info: %s" %(str(e)))
-                traceback.print_exc()
-                return listOfEbsInfo
-        if count >= retry:
-            print("Failed to get ebs volume info after retry")
-        return listOfEbsInfo
+def is_root_device(volume):
+    # Paravirtual reserves /dev/sda1 for root dev
+    # HVM could be either /dev/sda1 or /dev/xvda
+    if (('Attachments' in volume or volume['Attachments']) and
+        (len(volume['Attachments']) > 0)):
+        if (volume['Attachments'][0]['Device'] == "/dev/sda1" or
+            volume['Attachments'][0]['Device'] == "/dev/xvda"):
+            return True
+    return False
+
+#
+# Builds an EbsInfo struct from a volume returned by describe_volumes.
+# Returns None if the volume is a root device or if its statistics could
+# not be retrieved.  If cloudWatch is None, no statistics are queried and
+# the volume is treated as having no cloudwatch data.
+#
+def build_ebs_info(ec2Connection, cloudWatch, volume, useAvg, lookback=FC_STAT_DAYS):
+    # Skip root devices.
+    if (is_root_device(volume)):
+        return None
+
+    # get EBS tags
+    volTags = ec2Connection.describe_tags(
+        Filters=[{'Name': 'resource-id', 'Values': [volume['VolumeId']]}])
+    utcStr = arrow.now(FC_TIME_ZONE).format(TIME_FMT)
+    iops = volume['Iops'] if 'Iops' in volume else 0
+    kmsKeyId = volume['KmsKeyId'] if 'KmsKeyId' in volume else '0'
+    readIops = -1
+    writeIops = -1
+    if cloudWatch:
+        readIops, writeIops = get_volume_iops(cloudWatch, volume['VolumeId'], arrow.get(volume['CreateTime']).to(FC_TIME_ZONE).format(TIME_FMT), useAvg, lookback)
+
+    # skip vol on an error
+    if (readIops == -2 or writeIops == -2):
+        return None
+
+    # get volume name if it has one
+    volName = ""
+    for tag in volTags['Tags']:
+        if tag['Key'] == 'Name' and tag['Value']:
+            volName = tag['Value']
+            break
+
+    if (not 'Attachments' in volume or
+        not volume['Attachments'] or
+        len(volume['Attachments']) == 0):
+        return EbsInfo(
+            VolId       = volume['VolumeId'],
+            VolName     = volName,
+            Ec2Id       = "NA",
+            Ec2Name     = "",
+            Type        = volume['VolumeType'],
+            Size        = volume['Size'],
+            Device      = "NA",
+            AvailabilityZone = volume['AvailabilityZone'],
+            Iops        = iops,
+            UsedSize    = volume['Size'],
+            ReadIops    = readIops,
+            WriteIops   = writeIops,
+            CreateTime  = arrow.get(volume['CreateTime']).to(FC_TIME_ZONE).format(TIME_FMT),
+            State       = volume['State'],
+            Status      = FC_EBS_STATUS_UNATTACHED,
+            DeleteOnTermination = "NA",
+            CurrTime    = utcStr,
+            FcVol       = "NA",
+            Encrypted   = volume['Encrypted'],
+            KmsKeyId    = kmsKeyId,
+            Tags        = volTags['Tags'])
+
+    # get ec2 instance name if it has one
+    ec2Tags = ec2Connection.describe_tags(         \
+        Filters=[{'Name': 'resource-id', 'Values': \
+                [volume['Attachments'][0]['InstanceId']]}])
+
+    ec2Name = ""
+    for tag in ec2Tags['Tags']:
+        if tag['Key'] == 'Name' and tag['Value']:
+            ec2Name = tag['Value']
+            break
+
+    return EbsInfo(
+        VolId       = volume['VolumeId'],
+        VolName     = volName,
+        Ec2Id       = volume['Attachments'][0]['InstanceId'],
+        Ec2Name     = ec2Name,
+        Type        = volume['VolumeType'],
+        Size        = volume['Size'],
+        Device      = volume['Attachments'][0]['Device'],
+        AvailabilityZone = volume['AvailabilityZone'],
+        Iops        = iops,
+        UsedSize    = volume['Size'],
+        ReadIops    = readIops,
+        WriteIops   = writeIops,
+        CreateTime  = arrow.get(volume['CreateTime']).to(FC_TIME_ZONE).format(TIME_FMT),
+        State       = volume['State'],
+        Status      = FC_EBS_STATUS_ATTACHED,
+        DeleteOnTermination = volume['Attachments'][0]['DeleteOnTermination'],
+        CurrTime    = utcStr,
+        FcVol       = volume['Attachments'][0]['Device'],
+        Encrypted   = volume['Encrypted'],
+        KmsKeyId    = kmsKeyId,
+        Tags        = volTags['Tags'])
+
+#
+# Returns one page of describe_volumes, starting at nextToken, retrying
+# when the request limit is exceeded.  Returns None on failure.
+#
+def describe_volumes_page(ec2Connection, nextToken=None):
+    count = 0
+    retry = 5
+    kwargs = {'DryRun': False, 'MaxResults': FC_VOLUME_PAGE_SIZE}
+    if (nextToken != None):
+        kwargs['NextToken'] = nextToken
+    while count < retry:
+        count += 1
+        try:
+            return ec2Connection.describe_volumes(**kwargs)
+        except botocore.exceptions.ClientError as e:
+            print("Failed to describe volumes: %s" %(e.response['Error']['Message']))
+            if e.response['Error']['Code'] == 'Client.RequestLimitExceeded':
+                print("retry describe_volumes")
+                time.sleep(24*count)
+                continue
+            return None
+        except:
+            e = sys.exc_info()
+            print("Failed to describe volumes: %s" %(str(e)))
+            traceback.print_exc()
+            return None
+    print("Failed to describe volumes after retry")
+    return None
+
+#
+# Calls build_ebs_info for a single volume, retrying when the request limit
+# is exceeded, e.g. by describe_tags.  Returns None if the volume is
+# skipped or still fails, so callers can go on with the next volume.
+#
+def get_volume_ebs_info(ec2Connection, cloudWatch, volume, useAvg, lookback=FC_STAT_DAYS):
+    count = 0
+    retry = 5
+    while count < retry:
+        count += 1
+        try:
+            return build_ebs_info(ec2Connection, cloudWatch, volume, useAvg, lookback)
+        except botocore.exceptions.ClientError as e:
+            print("Failed to get ebs volume info, ebsId=%s: %s" %(volume['VolumeId'], e.response['Error']['Message']))
+            if e.response['Error']['Code'] == 'Client.RequestLimitExceeded':
+                print("retry ebs volume info")
+                time.sleep(24*count)
+                continue
+            return None
+        except:
+            e = sys.exc_info()
+            print("Failed to get ebs volume info, ebsId=%s: %s" %(volume['VolumeId'], str(e)))
+            traceback.print_exc()
+            return None
+    print("Failed to get ebs volume info after retry, ebsId=%s" %(volume['VolumeId']))
+    return None
+
+#
+# Queries all volumes in a region and yields them as EbsInfo structs.
+# Requires ec2Connection to describe_volumes and cloudWatch to query
+# statistics.  Only one page of volumes is held in memory at a time.
+#
+def iter_ebs_info(ec2Connection, cloudWatch, useAvg, lookback=FC_STAT_DAYS):
+    nextToken = None
+    while True:
+        page = describe_volumes_page(ec2Connection, nextToken)
+        if (page == None):
+            return
+        for volume in page['Volumes']:
+            ebsInfo = get_volume_ebs_info(ec2Connection, cloudWatch, volume, useAvg, lookback)
+            if (ebsInfo != None):
+                yield ebsInfo
+        nextToken = page.get('NextToken')
+        if (not nextToken):
+            return
+
+#
+# Returns the list of all volumes in a region, or None on failure.
+#
+def describe_all_volumes(ec2Connection):
+    volumes = []
+    nextToken = None
+    while True:
+        page = describe_volumes_page(ec2Connection, nextToken)
+        if (page == None):
+            return None
+        volumes.extend(page['Volumes'])
+        nextToken = page.get('NextToken')
+        if (not nextToken):
+            return volumes
 
 #
 # Pass EbsInfo struct as vol and return minimum available size in GB
-# Currently, only supports gp2, st1, sc1, and io1.
+# Currently, only supports gp2, gp3, st1, sc1, and io1.
 #
 def get_minimum_size(volType):
-    if (volType == 'gp2' or volType == 'standard'):
+    if (volType == 'gp2' or volType == 'gp3' or volType == 'standard'):
         return 1
     if (volType == 'st1'):
         return 500
@@ -366,11 +566,13 @@ def get_minimum_size(volType):
 
 #
 # Pass EbsInfo struct as vol and return maximum available size in GB
-# Currently, only supports gp2, st1, sc1, and io1.  Turns out they are all 16TB
+# Currently, only supports gp2, gp3, st1, sc1, and io1.  Turns out they are all 16TB
 #
 def get_maximum_size(volType):
     if (volType == 'gp2'):
         return 16*1024
+    if (volType == 'gp3'):
+        return 16*1024
     if (volType == 'st1'):
         return 16*1024
     if (volType == 'sc1'):
@@ -389,6 +591,8 @@ def get_maximum_size(volType):
 def get_minimum_iops(volType, size=0):
     if (volType == 'gp2'):
         return 100
+    if (volType == 'gp3'):
+        return GP3_BASELINE_IOPS
     if (volType == 'st1'):
         return 500
     if (volType == 'sc1'):
@@ -407,6 +611,8 @@ def get_minimum_iops(volType, size=0):
 def get_maximum_iops(volType, size=0):
     if (volType == 'gp2'):
         return 10000
+    if (volType == 'gp3'):
+        return 16000
     if (volType == 'st1'):
         return 500
     if (volType == 'sc1'):
@@ -421,7 +627,8 @@ def get_maximum_iops(volType, size=0):
 
 #
 # Return maximum available IOPS based on volume type and size
-# 'size' parameter only matters for gp2
+# 'size' parameter only matters for gp2.  For gp3, this is the baseline
+# available without provisioning IOPS.
 #
 def get_available_iops(volType, size=0):
     if (volType == 'gp2'):
@@ -432,6 +639,8 @@ def get_available_iops(volType, size=0):
             return get_maximum_iops('gp2')
         else:
             return iops
+    if (volType == 'gp3'):
+        return GP3_BASELINE_IOPS
     if (volType == 'st1'):
         return 500
     if (volType == 'sc1'):
@@ -444,21 +653,98 @@ def get_available_iops(volType, size=0):
     print("ERROR: invalid volume type: %s" %(volType))
     return -1
 
+#
+# Returns region, or FC_DEFAULT_REGION if ebs_monthly_rates has no rates
+# of rateType for region, e.g. for regions newer than the rates table.
+#
+def get_rate_region(rateType, region):
+    if (region in ebs_monthly_rates[rateType]):
+        return region
+    if (region not in unknown_rate_regions):
+        unknown_rate_regions.append(region)
+        # stderr keeps JSON output valid
+        sys.stderr.write("WARNING: no EBS rates for region %s, using %s rates\n"
+                         %(region, FC_DEFAULT_REGION))
+    return FC_DEFAULT_REGION
+
+#
+# Return monthly snapshot storage cost based on region and size in GB
+#
+def get_snapshot_rate(region, snapSize):
+    return ebs_monthly_rates['snapshot'][get_rate_region('snapshot', region)] * snapSize
+
 #
 # Return monthly rates based on volume type, size, region
-# and provisioned IOPS for io1
+# and provisioned IOPS for io1 and gp3
 #
 def get_monthly_rate(region, volType, volSize, volIops=0):
-    if (volType not in ['gp2', 'standard', 'sc1', 'st1', 'io1']):
+    if (volType not in FC_VOLUME_TYPES):
         print("ERROR: invalid volume type: %s" %(volType))
         return -1
 
+    region = get_rate_region(volType, region)
     cost = ebs_monthly_rates[volType][region] * volSize
     if (volType == 'io1'):
         cost += ebs_monthly_rates['iops'][region] * volIops
+    if (volType == 'gp3'):
+        cost += ebs_monthly_rates['gp3iops'][region] * max(0, volIops - GP3_BASELINE_IOPS)
 
     return cost
 
+#
+# Return the smallest (type, size, iops) configuration of volType that
+# holds at least volSize GB and serves totalIops, or None if volType
+# cannot serve the volume.  Sizes are never reduced here, that is left to
+# capacity rightsizing.
+#
+def get_candidate_config(volType, volSize, totalIops):
+    size = max(volSize, get_minimum_size(volType))
+    if (totalIops > get_maximum_iops(volType)):
+        return None
+
+    if (volType == 'gp2'):
+        # gp2 might need to grow to get enough IOPS
+        size = max(size, int(math.ceil(totalIops / float(GP2_IOPS_PER_GB))))
+        iops = get_available_iops('gp2', size)
+    elif (volType == 'gp3'):
+        iops = max(GP3_BASELINE_IOPS, int(math.ceil(totalIops)))
+        # the baseline is included at any size, only provisioned IOPS
+        # above it are limited by size
+        if (iops > GP3_BASELINE_IOPS):
+            size = max(size, int(math.ceil(iops / float(GP3_MAX_IOPS_PER_GB))))
+    elif (volType == 'io1'):
+        iops = max(get_minimum_iops('io1'), int(math.ceil(totalIops)))
+        size = max(size, int(math.ceil(iops / float(IO1_MAX_IOPS_PER_GB))))
+    else:
+        # st1, sc1 and standard have a fixed number of IOPS
+        if (totalIops >= get_available_iops(volType)):
+            return None
+        iops = get_available_iops(volType)
+
+    if (size > get_maximum_size(volType)):
+        return None
+    return volType, size, iops
+
+#
+# Evaluates the smallest feasible configuration of every type in
+# FC_MIGRATION_TYPES for a volume with the observed totalIops and returns
+# the cheapest one as (type, size, iops).  Returns the current
+# configuration if nothing is cheaper.
+#
+def get_cheapest_config(region, vol, totalIops):
+    best = (vol.Type, vol.Size, vol.Iops)
+    bestCost = get_monthly_rate(region, vol.Type, vol.Size, vol.Iops)
+    for volType in FC_MIGRATION_TYPES:
+        config = get_candidate_config(volType, vol.Size, totalIops)
+        if (config == None):
+            continue
+        cost = get_monthly_rate(region, config[0], config[1], config[2])
+        # require at least a cent to avoid advisories on rounding noise
+        if (cost < bestCost - 0.01):
+            best = config
+            bestCost = cost
+    return best
+
 #
 # Calculate cost savings of migration from old to new type, size, iops
 # returns savings per month
@@ -490,7 +776,7 @@ def dump_advisory_json(advInfo):
 # returns cost savings
 def capacity_rightsizing(region, volType, volSize, iops):
     newSize = max(volSize/2, get_minimum_size(volType))
-    if (volType == 'io1'):
+    if (volType == 'io1' or volType == 'gp3'):
         oldIops = iops
         newIops = iops
     else:
@@ -506,273 +792,1446 @@ def capacity_rightsizing(region, volType, volSize, iops):
                             newIops)
     return cost
 
+#
+# Builds an index of the account's own completed snapshots in a region
+# with a single paginated describe_snapshots sweep.  Returns a dictionary
+# mapping volume id to {'Count', 'Lineage', 'Latest'}, where Lineage lists
+# the snapshot ids oldest first and Latest describes the most recent
+# snapshot.  Returns None on failure.
+#
+def get_snapshot_index(ec2Connection):
+    index = {}
+    try:
+        paginator = ec2Connection.get_paginator('describe_snapshots')
+        for page in paginator.paginate(OwnerIds=['self']):
+            for snapshot in page['Snapshots']:
+                if (snapshot['State'] != 'completed'):
+                    continue
+                entry = index.setdefault(snapshot['VolumeId'],
+                                         {'Count': 0, 'Lineage': [], 'Latest': None})
+                entry['Count'] += 1
+                entry['Lineage'].append((snapshot['StartTime'], snapshot['SnapshotId']))
+                if (entry['Latest'] == None or
+                    snapshot['StartTime'] > entry['Latest']['StartTime']):
+                    entry['Latest'] = {'SnapshotId': snapshot['SnapshotId'],
+                                       'StartTime': snapshot['StartTime']}
+    except botocore.exceptions.ClientError as e:
+        print("Failed to describe snapshots: %s" %(e.response['Error']['Message']))
+        return None
+    except:
+        e = sys.exc_info()
+        print("Failed to describe snapshots: %s" %(str(e)))
+        return None
+
+    for entry in index.values():
+        entry['Lineage'] = [snapshotId for startTime, snapshotId in sorted(entry['Lineage'])]
+    return index
+
+#
+# Adds snapshot information to the advisory of an unattached volume and
+# estimates the savings net of snapshot storage.  snapInfo is the entry of
+# the volume in the snapshot index, or None if it has no snapshots.  If a
+# snapshot newer than FC_SNAPSHOT_RECENT_DAYS exists, the volume can be
+# deleted right away and its storage is already being paid for.  Otherwise
+# a new snapshot is assumed to hold FC_SNAPSHOT_USED_FRACTION of the
+# volume, the same overprovisioning assumption as capacity rightsizing.
+#
+# returns net cost savings
+def price_unattached_snapshot(region, advInfo, snapInfo):
+    latest = None
+    advInfo['SnapshotCount'] = 0
+    advInfo['SnapshotLineage'] = []
+    if (snapInfo != None):
+        latest = snapInfo['Latest']
+        advInfo['SnapshotCount'] = snapInfo['Count']
+        advInfo['SnapshotLineage'] = snapInfo['Lineage']
+
+    if (latest != None):
+        age = (arrow.now(FC_TIME_ZONE) - arrow.get(latest['StartTime'])).days
+        advInfo['LatestSnapshotId'] = latest['SnapshotId']
+        advInfo['LatestSnapshotTime'] = arrow.get(latest['StartTime']).to(FC_TIME_ZONE).format(TIME_FMT)
+        advInfo['LatestSnapshotAgeDays'] = age
+
+    if (latest != None and age <= FC_SNAPSHOT_RECENT_DAYS):
+        snapshotCost = 0
+        advInfo['Advice'] = "Delete, snapshot %s taken %d days ago already exists." \
+                            %(latest['SnapshotId'], age)
+    else:
+        snapshotCost = get_snapshot_rate(region, advInfo['Size'] * FC_SNAPSHOT_USED_FRACTION)
+        advInfo['Advice'] = "Take snapshot then delete."
+        if (latest != None):
+            advInfo['Advice'] += "  Latest snapshot %s is %d days old." \
+                                 %(latest['SnapshotId'], age)
+
+    net = round(advInfo['MonthlyCostSavings'] - snapshotCost, 2)
+    advInfo['EstimatedSnapshotCost'] = round(snapshotCost, 2)
+    advInfo['NetMonthlyCostSavings'] = net
+    return net
+
+#
+# Returns a new dictionary for tracking number and size of volumes analyzed
+# and the estimated cost savings.
+#
+def new_summary():
+    return {'gp2': {'count': 0, 'size': 0},
+            'gp3': {'count': 0, 'size': 0},
+            'st1': {'count': 0, 'size': 0},
+            'sc1': {'count': 0, 'size': 0},
+            'io1': {'count': 0, 'size': 0},
+            'standard': {'count': 0, 'size': 0},
+            'total_capacity': 0,
+            'num_advisories': 0,
+            'ebsmotion_savings': 0,
+            'unattached_savings': 0,
+            'capacity_savings': 0,
+            'total_savings': 0}
+
+#
+# Creates boto3 session, ec2 client and cloudwatch client for a region.
+# Returns None on failure.
+#
+def get_region_clients(access, secret, r):
+    try:
+        botoSession = boto3.Session(aws_access_key_id=access, aws_secret_access_key=secret, region_name=r)
+        botoClient = boto3.client('ec2', aws_access_key_id=access, aws_secret_access_key=secret, region_name=r)
+        cloudWatch = boto3.client('cloudwatch', aws_access_key_id=access, aws_secret_access_key=secret, region_name=r)
+    except botocore.exceptions.ClientError as e:
+        eMsg = e.response['Error']['Message']
+        print("ERROR: Failed to get boto3.Session error = %s" %(eMsg))
+        return None
+    except:
+        e = sys.exc_info()
+        print("ERROR: Failed to get boto3.Session region = %s error = %s" %(r, str(e)))
+        traceback.print_exc()
+        return None
+    return botoSession, botoClient, cloudWatch
+
+#
+# Runs the advisory rules against a single EbsInfo struct in region r.
+#
+# Returns a tuple (advInfo, totalIops, savingsType, cost) where advInfo is
+# the advisory dictionary or None if no advisory was found, savingsType is
+# one of 'ebsmotion', 'unattached' or 'capacity' and cost is the estimated
+# monthly cost savings for the volume.
+#
+def analyze_volume(r, vol, useAvg):
+    # no rates or limits for newer volume types, nothing to advise
+    if (vol.Type not in FC_VOLUME_TYPES):
+        return None, 0, 'capacity', 0
+
+    # for some reason, cloudwatch will return 0 for Iops
+    # for some volume types
+    if (vol.Iops == 0):
+        vol = vol._replace(Iops=get_available_iops(vol.Type, vol.Size))
+
+    # convert to dictionary
+    advInfo = vol._asdict()
+
+    # - RecommendedType will be changed if migrating to new type
+    # - RecommendedIops will be changed if the new configuration
+    # provisions a different number of IOPS
+    # - RecommendedSize will be changed if the new type has a larger
+    # minimum size or must be increased in size to meet IOPS demand
+    advInfo['RecommendedType'] = advInfo['Type']
+    advInfo['RecommendedIops'] = advInfo['Iops']
+    advInfo['RecommendedSize'] = advInfo['Size']
+    advInfo['Region'] = r;
+    if (useAvg == False):
+        advInfo['MetricType'] = "max"
+    else:
+        advInfo['MetricType'] = "avg"
+
+    totalIops = vol.ReadIops + vol.WriteIops
+
+    # for unattached ebs, estimate cost savings by assuming
+    # deletion of volume, as we cannot predict snapshot size
+    if (vol.Status == FC_EBS_STATUS_UNATTACHED):
+        advInfo['RecommendedSize'] = 0
+        advInfo['RecommendedIops'] = 0
+
+        # unattached and either too young or no cloudwatch data
+        if (totalIops < 0):
+            totalIops = 0
+
+    # if volume too young or no cloudwatch data, do ebs rightsizing
+    elif (vol.ReadIops == -1 or vol.WriteIops == -1):
+        cost = capacity_rightsizing(r, advInfo['Type'], advInfo['Size'], vol.Iops)
+        totalIops = 0 # set to zero to avoid confusing output
+        return None, totalIops, 'capacity', cost
+
+    # Migrate to the cheapest configuration that serves the observed IOPS
+    else:
+        newType, newSize, newIops = get_cheapest_config(r, vol, totalIops)
+        advInfo['RecommendedType'] = newType
+        advInfo['RecommendedSize'] = newSize
+        advInfo['RecommendedIops'] = newIops
+
+    # If no advisories, we can use FittedCloud's EBS rightsizing
+    if (advInfo['Type'] == advInfo['RecommendedType'] and
+        advInfo['Iops'] == advInfo['RecommendedIops'] and
+        advInfo['Size'] == advInfo['RecommendedSize'] and
+        advInfo['Status'] != FC_EBS_STATUS_UNATTACHED):
+        cost = capacity_rightsizing(r, advInfo['Type'], advInfo['Size'], vol.Iops)
+        return None, totalIops, 'capacity', cost
+
+    # calculate cost savings and advice string for an advisory
+    cost = get_cost_savings(r,
+                            advInfo['Type'],
+                            advInfo['Size'],
+                            advInfo['Iops'],
+                            advInfo['RecommendedType'],
+                            advInfo['RecommendedSize'],
+                            advInfo['RecommendedIops'])
+    # round to two decimal places
+    cost = round(cost, 2)
+
+    # record per-advisory cost savings
+    # per-advisory savings will be displayed in JSON output
+    advInfo['MonthlyCostSavings'] = cost
+
+    if (advInfo['Status'] == FC_EBS_STATUS_UNATTACHED):
+        advInfo['Advice'] = "Delete or take snapshot then delete."
+        return advInfo, totalIops, 'unattached', cost
+
+    advInfo['Advice'] = "Migrate to %s." %(advInfo['RecommendedType'])
+
+    if (advInfo['Size'] != advInfo['RecommendedSize']):
+        advInfo['Advice'] += "  Set size to %dGB." %(advInfo['RecommendedSize'])
+    # io1 and gp3 have provisioned IOPS, new gp3 volumes get the baseline
+    if (advInfo['Iops'] != advInfo['RecommendedIops'] and
+        (advInfo['RecommendedType'] == 'io1' or
+         (advInfo['RecommendedType'] == 'gp3' and
+          (advInfo['Type'] == 'gp3' or
+           advInfo['RecommendedIops'] != GP3_BASELINE_IOPS)))):
+        advInfo['Advice'] += "  Set Iops to %d IOPS." %(advInfo['RecommendedIops'])
+    return advInfo, totalIops, 'ebsmotion', cost
+
+#
+# Adds the result of analyze_volume for vol to the summary counters.
+#
+def update_summary(summary, vol, advInfo, savingsType, cost):
+    summary.setdefault(vol.Type, {'count': 0, 'size': 0})
+    summary[vol.Type]['count'] += 1
+    summary[vol.Type]['size'] += vol.Size
+    summary['total_capacity'] += vol.Size
+    if (advInfo != None):
+        summary['num_advisories'] += 1
+    summary[savingsType + '_savings'] += cost
+    summary['total_savings'] += cost
+
+#
+# Print a single advisory in the regular (non-JSON) format.
+#
+def print_advisory(advInfo, totalIops, lookback=FC_STAT_DAYS):
+    if (advInfo['VolName'] != ""):
+        vName = " (%s)" %(advInfo['VolName'])
+    else:
+        vName = ""
+
+    if (advInfo['Ec2Name'] != ""):
+        eName = " (%s)" %(advInfo['Ec2Name'])
+    else:
+        eName = ""
+    print(
+        "EBS Advisory:\n"
+        "\tRegion: %s\n"
+        "\tEC2 ID: %s%s\n"
+        "\tVolume ID: %s%s\n"
+        "\tCreate Time: %s\n"
+        "\tStatus: %s\n"
+        "\tType: %s\n"
+        "\tSize: %d GB\n"
+        "\tCurrent available IOPS: %d\n"
+        "\tOver a %d day period, %s IOPS observed %d\n"
+        "\tAdvice: %s\n"
+        "\tMonthly Cost Savings: $%.2f\n"
+        "%s"
+        %(advInfo['Region'],
+        advInfo['Ec2Id'],
+        eName,
+        advInfo["VolId"],
+        vName,
+        advInfo['CreateTime'],
+        advInfo['Status'],
+        advInfo['Type'],
+        advInfo['Size'],
+        get_available_iops(advInfo['Type'], advInfo['Size']),
+        lookback,
+        advInfo['MetricType'],
+        totalIops,
+        advInfo['Advice'],
+        advInfo['MonthlyCostSavings'],
+        "\tNet Monthly Cost Savings (after snapshot): $%.2f\n"
+        %(advInfo['NetMonthlyCostSavings'])
+        if 'NetMonthlyCostSavings' in advInfo else ""))
+
+#
+# Print the summary in the regular (non-JSON) format.
+#
+def print_summary(summary):
+    for k in summary.keys():
+        if (type(summary[k]) == type({})):
+            vols = "{:,}".format(summary[k]['count'])
+            size = "{:,}".format(summary[k]['size'])
+            print("Number of %s volumes analyzed: %s (Total Capacity: %s GB)"
+                  %(k, vols, size))
+
+    print("Total EBS Capacity: {:,} GB".format(summary['total_capacity']))
+    print("Total Advisories: {:,}".format(summary['num_advisories']))
+
+    # some formatting magic to line up dollar signs with the largest value
+    ebsmotion = "{:,.2f}".format(summary['ebsmotion_savings'])
+    unattached = "{:,.2f}".format(summary['unattached_savings'])
+    capacity = "{:,.2f}".format(summary['capacity_savings'])
+    total = "{:,.2f}".format(summary['total_savings'])
+    width = len(total)
+    print("Estimated Monthly Cost Savings:")
+    print("\tMigration/Type Switching:            ${0:{width}}{1}" \
+          .format("", ebsmotion, width=(width+1)-len(ebsmotion)))
+    print("\tUnattached EBS:                      ${0:{width}}{1}" \
+          .format("", unattached, width=(width+1)-len(unattached)))
+    if ('unattached_net_savings' in summary):
+        net = "{:,.2f}".format(summary['unattached_net_savings'])
+        print("\tUnattached EBS (net of snapshots):   ${0:{width}}{1}" \
+              .format("", net, width=(width+1)-len(net)))
+    print("\tCapacity Rightsizing (up to 50%):    ${0:{width}}{1}" \
+          .format("", capacity, width=(width+1)-len(capacity)))
+    print("\tTotal Savings:                       ${0:{width}}{1}" \
+          .format("", total, width=(width+1)-len(total)))
+
+#
+# Keeps the K advisories with the highest MonthlyCostSavings, either overall
+# or per group (region or type), in min-heaps of size K.
+#
+class TopAdvisories(object):
+    def __init__(self, k, groupBy='all'):
+        self.k = k
+        self.groupBy = groupBy
+        self.heaps = {}
+        self.count = 0
+
+    def group(self, advInfo):
+        if (self.groupBy == 'region'):
+            return advInfo['Region']
+        if (self.groupBy == 'type'):
+            return advInfo['Type']
+        return None
+
+    def add(self, advInfo, totalIops, savingsType):
+        # the sequence number keeps the earlier advisory on equal savings
+        self.count += 1
+        entry = (advInfo['MonthlyCostSavings'], -self.count,
+                 advInfo, totalIops, savingsType)
+        heap = self.heaps.setdefault(self.group(advInfo), [])
+        if (len(heap) < self.k):
+            heapq.heappush(heap, entry)
+        elif (entry[:2] > heap[0][:2]):
+            heapq.heapreplace(heap, entry)
+
+    #
+    # Returns a list of (group, [(advInfo, totalIops, savingsType), ...])
+    # sorted by group, with advisories sorted by savings, largest first.
+    #
+    def items(self):
+        result = []
+        for group in sorted(self.heaps.keys()):
+            entries = sorted(self.heaps[group], key=lambda e: e[:2], reverse=True)
+            result.append((group, [e[2:] for e in entries]))
+        return result
+
+#
+# Cost and savings totals of a group of volumes.  Aggregates can be merged,
+# e.g. to combine rollups computed for different regions or accounts.
+#
+class RollupAggregate(object):
+    FIELDS = ['count', 'capacity', 'monthly_cost', 'ebsmotion_savings',
+              'unattached_savings', 'capacity_savings', 'total_savings']
+
+    def __init__(self):
+        for field in self.FIELDS:
+            setattr(self, field, 0)
+
+    def add(self, region, vol, savingsType, cost):
+        self.count += 1
+        self.capacity += vol.Size
+        if (vol.Type in FC_VOLUME_TYPES):
+            self.monthly_cost += get_monthly_rate(region, vol.Type, vol.Size, vol.Iops)
+        setattr(self, savingsType + '_savings',
+                getattr(self, savingsType + '_savings') + cost)
+        self.total_savings += cost
+
+    def merge(self, other):
+        for field in self.FIELDS:
+            setattr(self, field, getattr(self, field) + getattr(other, field))
+
+    def as_dict(self):
+        return dict((field, getattr(self, field)) for field in self.FIELDS)
+
+#
+# Groups volumes by one or more dimensions joined with '+', e.g. "tag:team"
+# or "tag:env+az".  Dimensions are tag:<key>, instance, az, region, type
+# and account.  At most FC_ROLLUP_MAX_GROUPS groups are kept, further
+# groups are merged into FC_ROLLUP_OTHER so memory stays bounded.
+#
+class Rollup(object):
+    DIMENSIONS = ['instance', 'az', 'region', 'type', 'account']
+
+    def __init__(self, spec, account=""):
+        self.spec = spec
+        self.dims = spec.split('+')
+        self.account = account
+        self.groups = {}
+
+    #
+    # Returns an error message if spec is not a valid rollup, else None.
+    #
+    @staticmethod
+    def validate(spec):
+        for dim in spec.split('+'):
+            if (dim not in Rollup.DIMENSIONS and
+                not (dim.startswith('tag:') and len(dim) > 4)):
+                return "invalid group-by dimension: %s" %(dim)
+        return None
+
+    def key(self, region, vol):
+        values = []
+        for dim in self.dims:
+            if (dim == 'instance'):
+                values.append(vol.Ec2Id)
+            elif (dim == 'az'):
+                values.append(vol.AvailabilityZone)
+            elif (dim == 'region'):
+                values.append(region)
+            elif (dim == 'type'):
+                values.append(vol.Type)
+            elif (dim == 'account'):
+                values.append(self.account)
+            else:
+                value = FC_ROLLUP_NONE
+                for tag in vol.Tags:
+                    if (tag['Key'] == dim[4:]):
+                        value = tag['Value']
+                        break
+                values.append(value)
+        return "+".join(values)
+
+    def add(self, region, vol, savingsType, cost):
+        key = self.key(region, vol)
+        if (key not in self.groups and len(self.groups) >= FC_ROLLUP_MAX_GROUPS):
+            key = FC_ROLLUP_OTHER
+        if (key not in self.groups):
+            self.groups[key] = RollupAggregate()
+        self.groups[key].add(region, vol, savingsType, cost)
+
+    def merge(self, other):
+        for key, aggregate in other.groups.items():
+            if (key not in self.groups and len(self.groups) >= FC_ROLLUP_MAX_GROUPS):
+                key = FC_ROLLUP_OTHER
+            self.groups.setdefault(key, RollupAggregate()).merge(aggregate)
+
+    #
+    # Returns a list of (group, aggregate) sorted by total savings,
+    # largest first.
+    #
+    def items(self):
+        return sorted(self.groups.items(),
+                      key=lambda item: (-item[1].total_savings, item[0]))
+
+    def as_json(self):
+        result = []
+        for key, aggregate in self.items():
+            group = aggregate.as_dict()
+            group['group'] = key
+            result.append(group)
+        return result
+
+    def print_table(self):
+        headers = [self.spec, "Volumes", "Capacity (GB)", "Monthly Cost",
+                   "Migration", "Unattached", "Capacity", "Total Savings"]
+        rows = []
+        for key, g in self.items():
+            rows.append([key,
+                         "{:,}".format(g.count),
+                         "{:,}".format(g.capacity),
+                         "${:,.2f}".format(g.monthly_cost),
+                         "${:,.2f}".format(g.ebsmotion_savings),
+                         "${:,.2f}".format(g.unattached_savings),
+                         "${:,.2f}".format(g.capacity_savings),
+                         "${:,.2f}".format(g.total_savings)])
+        widths = [max(len(row[i]) for row in rows + [headers])
+                  for i in range(len(headers))]
+        print("Rollup by %s:" %(self.spec))
+        for row in [headers] + rows:
+            cells = [row[0].ljust(widths[0])]
+            cells += [row[i].rjust(widths[i]) for i in range(1, len(row))]
+            print("\t" + "  ".join(cells))
+        print("")
+
+#
+# Returns the AWS account id of the credentials, or "unknown".
+#
+def get_account_id(access, secret):
+    try:
+        sts = boto3.client('sts', aws_access_key_id=access, aws_secret_access_key=secret, region_name=FC_DEFAULT_REGION)
+        return sts.get_caller_identity()['Account']
+    except:
+        e = sys.exc_info()
+        print("Failed to get account id: %s" %(str(e)))
+        return "unknown"
+
 #
 # Loops through region list and finds volumes that can benefit from migration.
+# If server is given, the advisories are published to it once all regions
+# have been analyzed.  If top is given, only the advisories kept by the
+# TopAdvisories object are output, but the summary covers all volumes.
+# lookback is the number of days of metrics to analyze.  Every volume is
+# also added to each Rollup in rollups, which are output after the summary.
+# If snapshots is True, unattached volumes are priced against a snapshot
+# index built once per region.
 #
-def analyze_ebs_motion(access, secret, rList, useAvg, useJson):
+def analyze_ebs_motion(access, secret, rList, useAvg, useJson, server=None, top=None,
+                       lookback=FC_STAT_DAYS, rollups=[], snapshots=False):
     # json lists for advisories
     json_advisory = {"Migration": [], "Unattached": []}
+    # all advisories, only kept when publishing to the query service
+    advisories = []
+    # number of volumes analyzed per region, for ordering regions next time
+    regionSizes = {}
 
     # dictionary for tracking number and size of volumes analyzed
-    summary = {'gp2': {'count': 0, 'size': 0},
-               'st1': {'count': 0, 'size': 0},
-               'sc1': {'count': 0, 'size': 0},
-               'io1': {'count': 0, 'size': 0},
-               'standard': {'count': 0, 'size': 0},
-               'total_capacity': 0,
-               'num_advisories': 0,
-               'ebsmotion_savings': 0,
-               'unattached_savings': 0,
-               'capacity_savings': 0,
-               'total_savings': 0}
+    summary = new_summary()
 
     # loop through region list
     for r in rList:
         advisory_found = 0
-        try:
-            botoSession = boto3.Session(aws_access_key_id=access, aws_secret_access_key=secret, region_name=r)
-            botoClient = boto3.client('ec2', aws_access_key_id=access, aws_secret_access_key=secret, region_name=r)
-            cloudWatch = boto3.client('cloudwatch', aws_access_key_id=access, aws_secret_access_key=secret, region_name=r)
-        except botocore.exceptions.ClientError as e:
-            eMsg = e.response['Error']['Message']
-            print("ERROR: Failed to get boto3.Session error = %s" %(eMsg))
-            return
-        except:
-            e = sys.exc_info()
-            print("ERROR: Failed to get boto3.Session region = %s error = %s" %(r, str(e)))
-            traceback.print_exc()
+        clients = get_region_clients(access, secret, r)
+        if (clients == None):
             return
-
-        ec2resource = botoSession.resource('ec2')
-
-        ebsList = ec2resource.volumes.all()
-
-        # fetch all volume information for region in one call
-        volList = []
-        for ebs in ebsList:
-            volList.append(ebs.id)
-        ebs_info = get_ebs_info(botoClient, cloudWatch, volList, useAvg)
-
-        for vol in ebs_info:
-            # update counters
-            summary[vol.Type]['count'] += 1
-            summary[vol.Type]['size'] += vol.Size
-            summary['total_capacity'] += vol.Size
-
-            # for some reason, cloudwatch will return 0 for Iops
-            # for some volume types
-            if (vol.Iops == 0):
-                vol = vol._replace(Iops=get_available_iops(vol.Type, vol.Size))
-
-            # convert to dictionary
-            advInfo = vol._asdict()
-
-            # - RecommendedType will be changed if migrating to new type
-            # - RecommendedIops will be changed if io1 migrates to io1
-            # with fewer provisioned IOPS
-            # - RecommendedSize will be changed if io1 -> gp2, but gp2
-            # must be increased in size to meet IOPS demand
-            advInfo['RecommendedType'] = advInfo['Type']
-            advInfo['RecommendedIops'] = advInfo['Iops']
-            advInfo['RecommendedSize'] = advInfo['Size']
-            advInfo['Region'] = r;
-            if (useAvg == False):
-                advInfo['MetricType'] = "max"
-            else:
-                advInfo['MetricType'] = "avg"
-
-            totalIops = vol.ReadIops + vol.WriteIops
-
-            # for unattached ebs, estimate cost savings by assuming
-            # deletion of volume, as we cannot predict snapshot size
-            if (vol.Status == FC_EBS_STATUS_UNATTACHED):
-                advInfo['RecommendedSize'] = 0
-                advInfo['RecommendedIops'] = 0
-
-                # unattached and either too young or no cloudwatch data
-                if (totalIops < 0):
-                    totalIops = 0
-
-            # if volume too young or no cloudwatch data, do ebs rightsizing
-            elif (vol.ReadIops == -1 or vol.WriteIops == -1):
-                cost = capacity_rightsizing(r, advInfo['Type'], advInfo['Size'], vol.Iops)
-                totalIops = 0 # set to zero to avoid confusing output
-                summary['capacity_savings'] += cost
-                summary['total_savings'] += cost
-
-            # Migration of GP2
-            elif (vol.Type == 'gp2'):
-                # There may be cases where we can save money by
-                # migrating a gp2 less than 500GB to st1 or sc1
-                # but using a simple heuristic for now.
-                if (vol.Size >= get_minimum_size('st1')):
-                    if (totalIops < get_available_iops('st1')):
-                        advInfo['RecommendedType'] = 'st1'
-                        advInfo['RecommendedIops'] = get_available_iops('sc1')
-                if (vol.Size >= get_minimum_size('sc1')):
-                    if (totalIops < get_available_iops('sc1')):
-                        advInfo['RecommendedType'] = 'sc1'
-                        advInfo['RecommendedIops'] = get_available_iops('sc1')
-
-            # Migration of ST1
-            elif (vol.Type == 'st1'):
-                if (totalIops < get_available_iops('sc1')):
-                    advInfo['RecommendedType'] = 'sc1'
-                    advInfo['RecommendedIops'] = get_available_iops('sc1')
-
-            # Migration of IO1
-            elif (vol.Type == 'io1'):
-                if (totalIops < get_maximum_iops('gp2')):
-                    if (totalIops >= vol.Iops * IO1_IOPS_THRESHOLD):
-                        advInfo['RecommendedType'] = 'gp2'
-
-                        # Might need to increase size of gp2 to get same
-                        # IOPS as io1's provisioned IOPS
-                        if (vol.Size * GP2_IOPS_PER_GB < totalIops):
-                            advInfo['RecommendedSize'] = roundup(totalIops / GP2_IOPS_PER_GB)
-                            advInfo['RecommendedIops'] = advInfo['RecommendedSize'] * GP2_IOPS_PER_GB
-                    else:
-                        advInfo['RecommendedIops'] = max(totalIops, get_minimum_iops('io1'))
-
-            # Migration of magnetic
-            elif (vol.Type == 'standard'):
-                # SC1 is roughly half the price per GB than magnetic, but
-                # has a minimum size of 500GB.  It's possible in some
-                # regions that migrating a 250GB magnetic to 500GB SC1
-                # will cost more.  Using simple heuristic for size checking.
-                if ((vol.Size >= get_minimum_size('sc1')) and
-                    (vol.Size < get_maximum_size('sc1'))):
-                    advInfo['RecommendedType'] = 'sc1'
-
-            # calculate cost savings and advice string for an advisory
-            if (advInfo['Type'] != advInfo['RecommendedType'] or
-                advInfo['Iops'] != advInfo['RecommendedIops'] or
-                advInfo['Size'] != advInfo['RecommendedSize'] or
-                advInfo['Status'] == FC_EBS_STATUS_UNATTACHED):
-
-                # only needed for commented-out message below
-                advisory_found = 1
-
-                # update counter
-                summary['num_advisories'] += 1
-                cost = get_cost_savings(r,
-                                        advInfo['Type'],
-                                        advInfo['Size'],
-                                        advInfo['Iops'],
-                                        advInfo['RecommendedType'],
-                                        advInfo['RecommendedSize'],
-                                        advInfo['RecommendedIops'])
-                # round to two decimal places
-                cost = round(cost, 2)
-
-                # record total and per-advisory cost savings
-                # per-advisory savings will be displayed in JSON output
-                advInfo['MonthlyCostSavings'] = cost
-                summary['total_savings'] += cost
-
-                if (advInfo['Status'] == FC_EBS_STATUS_UNATTACHED):
-                    advInfo['Advice'] = "Delete or take snapshot then delete."
-                    summary['unattached_savings'] += cost
-                    if (useJson == True):
-                        json_advisory['Unattached'].append(advInfo)
-
+        botoSession, botoClient, cloudWatch = clients
+
+        snapIndex = None
+        if (snapshots == True):
+            snapIndex = get_snapshot_index(botoClient)
+
+        # volumes are streamed one describe_volumes page at a time
+        regionSizes[r] = 0
+        for vol in iter_ebs_info(botoClient, cloudWatch, useAvg, lookback):
+            regionSizes[r] += 1
+            advInfo, totalIops, savingsType, cost = analyze_volume(r, vol, useAvg)
+            update_summary(summary, vol, advInfo, savingsType, cost)
+            for rollup in rollups:
+                rollup.add(r, vol, savingsType, cost)
+            if (advInfo == None):
+                continue
+
+            if (savingsType == 'unattached' and snapIndex != None):
+                net = price_unattached_snapshot(r, advInfo, snapIndex.get(vol.VolId))
+                summary['unattached_net_savings'] = \
+                    summary.get('unattached_net_savings', 0) + net
+
+            # only needed for commented-out message below
+            advisory_found = 1
+
+            if (top != None):
+                top.add(advInfo, totalIops, savingsType)
+                continue
+
+            if (server != None):
+                advisories.append(advInfo)
+
+            if (useJson == True):
+                if (savingsType == 'unattached'):
+                    json_advisory['Unattached'].append(advInfo)
                 else:
-                    # update cost savings for migration
-                    summary['ebsmotion_savings'] += cost
-
-                    advInfo['Advice'] = "Migrate to %s." %(advInfo['RecommendedType'])
-
-                    if (advInfo['Size'] != advInfo['RecommendedSize']):
-                        advInfo['Advice'] += "  Set size to %dGB." %(advInfo['RecommendedSize'])
-                    # io1 -> io1 with fewer provisioned IOPS
-                    elif (advInfo['Iops'] != advInfo['RecommendedSize'] and
-                          advInfo['Type'] == advInfo['RecommendedType']):
-                        advInfo['Advice'] += "  Set Iops to %d IOPS." %(advInfo['RecommendedIops'])
-                    if (useJson == True):
-                        json_advisory['Migration'].append(advInfo)
-
-                # Finally, dump the output if there is an advisory
-                if (useJson == False):
-                    if (advInfo['VolName'] != ""):
-                        vName = " (%s)" %(advInfo['VolName'])
-                    else:
-                        vName = ""
-
-                    if (advInfo['Ec2Name'] != ""):
-                        eName = " (%s)" %(advInfo['Ec2Name'])
-                    else:
-                        eName = ""
-                    print(
-                        "EBS Advisory:\n"
-                        "\tRegion: %s\n"
-                        "\tEC2 ID: %s%s\n"
-                        "\tVolume ID: %s%s\n"
-                        "\tCreate Time: %s\n"
-                        "\tStatus: %s\n"
-                        "\tType: %s\n"
-                        "\tSize: %d GB\n"
-                        "\tCurrent available IOPS: %d\n"
-                        "\tOver a %d day period, %s IOPS observed %d\n"
-                        "\tAdvice: %s\n"
-                        "\tMonthly Cost Savings: $%.2f\n"
-                        %(advInfo['Region'],
-                        advInfo['Ec2Id'],
-                        eName,
-                        advInfo["VolId"],
-                        vName,
-                        advInfo['CreateTime'],
-                        advInfo['Status'],
-                        advInfo['Type'],
-                        advInfo['Size'],
-                        get_available_iops(advInfo['Type'], advInfo['Size']),
-                        FC_STAT_DAYS,
-                        advInfo['MetricType'],
-                        totalIops,
-                        advInfo['Advice'],
-                        advInfo['MonthlyCostSavings']))
-
-            # If no advisories, we can use FittedCloud's EBS rightsizing
+                    json_advisory['Migration'].append(advInfo)
             else:
-                cost = capacity_rightsizing(r, advInfo['Type'], advInfo['Size'], vol.Iops)
-                summary['capacity_savings'] += cost
-                summary['total_savings'] += cost
+                # Finally, dump the output if there is an advisory
+                print_advisory(advInfo, totalIops, lookback)
 
         # No advisories found for this region.
         # Uncomment if you want to print out a message.
         #if (advisory_found == 0):
         #    print("No advisories for Region=%s" %(r))
 
+    record_region_sizes(access, regionSizes)
+
+    # Output the top advisories now that all volumes have been seen
+    if (top != None):
+        for group, entries in top.items():
+            if (useJson == False and group != None):
+                print("Top %d advisories for %s %s:\n" %(top.k, top.groupBy, group))
+            for advInfo, totalIops, savingsType in entries:
+                if (server != None):
+                    advisories.append(advInfo)
+                if (useJson == True):
+                    if (savingsType == 'unattached'):
+                        json_advisory['Unattached'].append(advInfo)
+                    else:
+                        json_advisory['Migration'].append(advInfo)
+                else:
+                    print_advisory(advInfo, totalIops, lookback)
+
     # Print a summary if not using JSON output
     if (useJson == False):
-        total_capacity = 0
-        for k in summary.keys():
-            if (type(summary[k]) == type({})):
-                vols = "{:,}".format(summary[k]['count'])
-                size = "{:,}".format(summary[k]['size'])
-                print("Number of %s volumes analyzed: %s (Total Capacity: %s GB)"
-                      %(k, vols, size))
-
-        print("Total EBS Capacity: {:,} GB".format(summary['total_capacity']))
-        print("Total Advisories: {:,}".format(summary['num_advisories']))
-
-        # some formatting magic to line up dollar signs with the largest value
-        ebsmotion = "{:,.2f}".format(summary['ebsmotion_savings'])
-        unattached = "{:,.2f}".format(summary['unattached_savings'])
-        capacity = "{:,.2f}".format(summary['capacity_savings'])
-        total = "{:,.2f}".format(summary['total_savings'])
-        width = len(total)
-        print("Estimated Monthly Cost Savings:")
-        print("\tMigration/Type Switching:            ${0:{width}}{1}" \
-              .format("", ebsmotion, width=(width+1)-len(ebsmotion)))
-        print("\tUnattached EBS:                      ${0:{width}}{1}" \
-              .format("", unattached, width=(width+1)-len(unattached)))
-        print("\tCapacity Rightsizing (up to 50%):    ${0:{width}}{1}" \
-              .format("", capacity, width=(width+1)-len(capacity)))
-        print("\tTotal Savings:                       ${0:{width}}{1}" \
-              .format("", total, width=(width+1)-len(total)))
+        print_summary(summary)
+        if (len(rollups) > 0):
+            print("")
+        for rollup in rollups:
+            rollup.print_table()
+    else:
+        dump_advisory_json({'Advisories': json_advisory})
+        dump_advisory_json({'Summary': summary})
+        if (len(rollups) > 0):
+            dump_advisory_json({'Rollups': dict((rollup.spec, rollup.as_json())
+                                                for rollup in rollups)})
+
+    if (server != None):
+        server.publish(advisories, summary)
+
+#
+# Returns the label of the savings bucket for a monthly cost savings value,
+# e.g. "10-50" or "1000+".
+#
+def savings_bucket(cost):
+    for i in range(len(FC_SAVINGS_BUCKETS) - 1, -1, -1):
+        if (cost >= FC_SAVINGS_BUCKETS[i]):
+            if (i == len(FC_SAVINGS_BUCKETS) - 1):
+                return "%d+" %(FC_SAVINGS_BUCKETS[i])
+            return "%d-%d" %(FC_SAVINGS_BUCKETS[i], FC_SAVINGS_BUCKETS[i+1])
+    return "<%d" %(FC_SAVINGS_BUCKETS[0])
+
+#
+# Read-only, in-memory index over a list of advisories.  Advisories are
+# stored sorted by MonthlyCostSavings (largest first) and secondary indexes
+# map region, type, instance id, status, tag ("Key=Value") and savings
+# bucket to sorted lists of positions, so queries only touch the advisories
+# matching their most selective filter.  Positions are also pre-sorted by
+# each of SORT_FIELDS, so other sort orders need no sort per query.
+#
+class AdvisoryIndex(object):
+    FIELDS = {'region': 'Region',
+              'type': 'Type',
+              'instance': 'Ec2Id',
+              'status': 'Status'}
+    SORT_FIELDS = ['VolId', 'Region', 'Type', 'Ec2Id', 'Size', 'Iops', 'CreateTime']
+
+    def __init__(self, advisories, summary):
+        self.summary = summary
+        self.advisories = sorted(advisories,
+                                 key=lambda a: (-a['MonthlyCostSavings'], a['VolId']))
+        # negated savings in ascending order, for bisect
+        self.savings = [-a['MonthlyCostSavings'] for a in self.advisories]
+        self.indexes = {'tag': {}, 'bucket': {}}
+        # (index name, value) -> frozenset of positions, built on demand
+        self.sets = {}
+        for name in self.FIELDS:
+            self.indexes[name] = {}
+
+        for pos, adv in enumerate(self.advisories):
+            for name, field in self.FIELDS.items():
+                self.indexes[name].setdefault(adv[field], []).append(pos)
+            for tag in adv['Tags']:
+                self.indexes['tag'].setdefault("%s=%s" %(tag['Key'], tag['Value']), []).append(pos)
+            self.indexes['bucket'].setdefault(savings_bucket(adv['MonthlyCostSavings']), []).append(pos)
+
+        # field -> positions sorted by (value, position)
+        self.orders = {}
+        for field in self.SORT_FIELDS:
+            keys = sorted((adv.get(field), pos) for pos, adv in enumerate(self.advisories))
+            self.orders[field] = [pos for value, pos in keys]
+
+    #
+    # Returns the sorted positions matching any of the values of a filter.
+    #
+    def lookup(self, name, values):
+        if (len(values) == 1):
+            return self.indexes[name].get(values[0], [])
+        positions = set()
+        for v in values:
+            positions.update(self.indexes[name].get(v, []))
+        return sorted(positions)
+
+    #
+    # Same as lookup but returns a set of positions.
+    #
+    def lookup_set(self, name, values):
+        sets = []
+        for v in values:
+            if ((name, v) not in self.sets):
+                self.sets[(name, v)] = frozenset(self.indexes[name].get(v, []))
+            sets.append(self.sets[(name, v)])
+        if (len(sets) == 1):
+            return sets[0]
+        return frozenset().union(*sets)
+
+    #
+    # filters maps an index name to a list of accepted values.  Different
+    # filters are ANDed and values of the same filter are ORed.
+    # Returns the total number of matches and the requested page.
+    #
+    def query(self, filters, minSavings=None, maxSavings=None,
+              sortKey='MonthlyCostSavings', reverse=True, offset=0, limit=100):
+        # contiguous range of positions within the savings bounds
+        lo = 0
+        hi = len(self.advisories)
+        if (maxSavings != None):
+            lo = bisect.bisect_left(self.savings, -maxSavings)
+        if (minSavings != None):
+            hi = bisect.bisect_right(self.savings, -minSavings)
+
+        # without filters, the default sort order is a slice of the range
+        if (len(filters) == 0 and sortKey == 'MonthlyCostSavings'):
+            if (reverse == True):
+                page = range(lo + offset, min(hi, lo + offset + limit))
+            else:
+                page = range(hi - 1 - offset, max(lo, hi - offset - limit) - 1, -1)
+            return max(0, hi - lo), [self.advisories[pos] for pos in page]
+
+        # intersect the shortest posting list with the sets of the others
+        postings = [(self.lookup(name, values), name, values)
+                    for name, values in filters.items()]
+        postings.sort(key=lambda p: len(p[0]))
+        if (len(postings) == 0):
+            matches = range(lo, hi)
+        else:
+            first = postings[0][0]
+            matches = first[bisect.bisect_left(first, lo):bisect.bisect_left(first, hi)]
+            if (len(postings) > 1):
+                common = set(matches)
+                for positions, name, values in postings[1:]:
+                    common &= self.lookup_set(name, values)
+                matches = sorted(common)
+
+        if (sortKey == 'MonthlyCostSavings'):
+            if (reverse == False):
+                matches = matches[::-1]
+            page = [self.advisories[pos] for pos in matches[offset:offset+limit]]
+            return len(matches), page
+
+        # sort small results, walk the pre-sorted order for large ones and
+        # stop as soon as the page is complete
+        total = len(matches)
+        order = self.orders[sortKey]
+        if (total <= len(order) / 16):
+            matches = sorted(matches, key=lambda pos: (self.advisories[pos].get(sortKey), pos),
+                             reverse=reverse)
+            page = matches[offset:offset+limit]
+        else:
+            if (len(filters) == 0):
+                common = None
+            else:
+                common = set(matches)
+            page = []
+            skip = offset
+            for pos in (reversed(order) if reverse == True else order):
+                if (len(page) >= limit):
+                    break
+                if (common != None and pos not in common):
+                    continue
+                if (common == None and not lo <= pos < hi):
+                    continue
+                if (skip > 0):
+                    skip -= 1
+                    continue
+                page.append(pos)
+        return total, [self.advisories[pos] for pos in page]
+
+#
+# HTTP request handler for the advisory query service.  Supports
+#   GET /summary
+#   GET /advisories?region=..&type=..&instance=..&status=..&tag=Key=Value
+#                   &bucket=..&min_savings=..&max_savings=..&sort=..
+#                   &order=asc|desc&offset=..&limit=..
+#
+class AdvisoryRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        params = urlparse.parse_qs(url.query)
+        index = self.server.index
+        if (index == None):
+            self.send_json(503, {'Error': "No results available yet"})
+        elif (url.path == '/summary'):
+            self.send_json(200, {'Summary': index.summary})
+        elif (url.path == '/advisories'):
+            try:
+                self.send_json(200, self.query(index, params))
+            except ValueError as e:
+                self.send_json(400, {'Error': str(e)})
+        else:
+            self.send_json(404, {'Error': "Unknown path %s" %(url.path)})
+
+    def query(self, index, params):
+        filters = {}
+        for name in index.indexes:
+            if (name in params):
+                filters[name] = params[name]
+        minSavings = float(params['min_savings'][0]) if 'min_savings' in params else None
+        maxSavings = float(params['max_savings'][0]) if 'max_savings' in params else None
+        sortKey = params['sort'][0] if 'sort' in params else 'MonthlyCostSavings'
+        if (sortKey != 'MonthlyCostSavings' and sortKey not in index.SORT_FIELDS):
+            raise ValueError("unknown sort field: %s" %(sortKey))
+        reverse = not ('order' in params and params['order'][0] == 'asc')
+        offset = int(params['offset'][0]) if 'offset' in params else 0
+        limit = int(params['limit'][0]) if 'limit' in params else FC_SERVE_DEFAULT_LIMIT
+        if (offset < 0 or limit < 0):
+            raise ValueError("offset and limit must not be negative")
+        limit = min(limit, FC_SERVE_MAX_LIMIT)
+
+        total, page = index.query(filters, minSavings, maxSavings,
+                                  sortKey, reverse, offset, limit)
+        return {'Total': total, 'Offset': offset, 'Limit': limit,
+                'Advisories': page}
+
+    def send_json(self, code, body):
+        data = json.dumps(body, sort_keys=True)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+class AdvisoryServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address):
+        BaseHTTPServer.HTTPServer.__init__(self, address, AdvisoryRequestHandler)
+        self.index = None
+
+    #
+    # Replaces the results being served.  Requests in flight keep using the
+    # index they started with.
+    #
+    def publish(self, advisories, summary):
+        self.index = AdvisoryIndex(advisories, summary)
+
+    #
+    # Answers queries in a background thread.  Requests made before the
+    # first results are published get a 503.
+    #
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+#
+# Creates an AdvisoryServer from a "[host:]port" string and starts serving.
+# Binds to localhost if no host is given.
+#
+def start_server(address):
+    if (':' in address):
+        host, port = address.rsplit(':', 1)
+    else:
+        host, port = FC_SERVE_HOST, address
+    try:
+        server = AdvisoryServer((host, int(port)))
+    except:
+        e = sys.exc_info()
+        print("ERROR: Failed to start query service on %s error = %s" %(address, str(e)))
+        return None
+    server.start()
+    # stderr keeps JSON output valid
+    sys.stderr.write("Serving advisories on http://%s:%d/\n" %(host, server.server_address[1]))
+    return server
+
+#
+# Returns a tuple describing the configuration of a volume returned by
+# describe_volumes.  The daemon uses it to detect volumes that changed
+# between two refreshes of a region.
+#
+def volume_signature(volume):
+    if ('Attachments' in volume and volume['Attachments'] and
+        len(volume['Attachments']) > 0):
+        ec2Id = volume['Attachments'][0]['InstanceId']
+        device = volume['Attachments'][0]['Device']
+    else:
+        ec2Id = "NA"
+        device = "NA"
+    return (volume['VolumeType'],
+            volume['Size'],
+            volume['Iops'] if 'Iops' in volume else 0,
+            volume['State'],
+            ec2Id,
+            device)
+
+#
+# Token bucket that caps the rate of volume metric queries across all
+# regions in daemon mode.  Tokens accrue at 'rate' per second up to the
+# amount of one FC_DAEMON_MIN_INTERVAL.  Each region may take at most its
+# share of a full bucket, proportional to its number of volumes, so a
+# large backlog in one region does not starve the others.
+#
+class MetricRateLimiter(object):
+    def __init__(self, rate):
+        self.rate = rate
+        self.burst = rate * FC_DAEMON_MIN_INTERVAL
+        self.tokens = self.burst
+        self.time = None
+        # region -> number of volumes at its last refresh
+        self.sizes = {}
+
+    #
+    # Returns how many of 'wanted' metric queries region may run now.
+    #
+    def take(self, now, region, numVols, wanted):
+        if (self.time != None):
+            self.tokens = min(self.burst, self.tokens + (now - self.time) * self.rate)
+        self.time = now
+        self.sizes[region] = numVols
+        share = self.burst * float(numVols) / max(1, sum(self.sizes.values()))
+        granted = int(min(wanted, self.tokens, max(1, math.ceil(share))))
+        self.tokens -= granted
+        return granted
+
+#
+# In-memory volume and advisory model of a single region, used by daemon
+# mode.  Keeps the boto clients warm between refreshes and only queries
+# CloudWatch for volumes that are new, changed or have stale metrics.
+#
+class RegionModel(object):
+    def __init__(self, region, clients, useAvg, lookback=FC_STAT_DAYS):
+        self.region = region
+        self.botoSession, self.botoClient, self.cloudWatch = clients
+        self.useAvg = useAvg
+        self.lookback = lookback
+        # VolId -> [signature, EbsInfo or None for root devices, metric time]
+        self.volumes = {}
+        # VolIds seen in describe_volumes but still waiting for metrics, in
+        # the order they are queried (keys only, values are unused)
+        self.pending = OrderedDict()
+        # list of (vol, advInfo, totalIops, savingsType, cost)
+        self.results = []
+        self.changeRate = 0.0
+        self.interval = FC_DAEMON_MAX_INTERVAL
+        self.nextRefresh = 0
+        # volumes that needed metrics but were left for a later refresh
+        self.backlog = 0
+
+    #
+    # Refreshes the inventory of the region with a single paginated
+    # describe_volumes and queries metrics of new, changed and stale
+    # volumes, as many as limiter allows (all of them if limiter is None).
+    # Stale volumes always get the share of the budget needed to refresh
+    # the whole region once per FC_DAEMON_METRIC_TTL, so they are not
+    # starved by pending ones.  Returns False if the inventory could not
+    # be retrieved.
+    #
+    def refresh(self, now, limiter=None):
+        inventory = describe_all_volumes(self.botoClient)
+        if (inventory == None):
+            self.nextRefresh = now + FC_DAEMON_MIN_INTERVAL
+            return False
+
+        changed = 0
+        seen = {}
+        for volume in inventory:
+            volId = volume['VolumeId']
+            sig = volume_signature(volume)
+            seen[volId] = volume
+            # volumes still waiting for metrics were counted when first seen
+            if (volId not in self.volumes):
+                if (volId not in self.pending):
+                    changed += 1
+                    self.pending[volId] = True
+            elif (self.volumes[volId][0] != sig):
+                changed += 1
+                del self.volumes[volId]
+                self.pending[volId] = True
+
+        # forget volumes that have been deleted
+        for volId in list(self.volumes.keys()):
+            if (volId not in seen):
+                changed += 1
+                del self.volumes[volId]
+        for volId in [v for v in self.pending if v not in seen]:
+            del self.pending[volId]
+
+        # new and changed volumes first, then the stalest metrics
+        stale = [(entry[2], volId) for volId, entry in self.volumes.items()
+                 if (entry[1] != None and
+                     now - entry[2] >= FC_DAEMON_METRIC_TTL)]
+        stale.sort()
+        wanted = len(self.pending) + len(stale)
+        granted = wanted
+        if (limiter != None):
+            granted = limiter.take(now, self.region, len(inventory), wanted)
+        reserve = int(math.ceil(len(self.volumes) * self.interval / float(FC_DAEMON_METRIC_TTL)))
+        reserve = min(len(stale), granted, reserve)
+        numPending = min(len(self.pending), granted - reserve)
+        todo = self.pending.keys()[:numPending]
+        for metricTime, volId in stale[:granted - numPending]:
+            todo.append(volId)
+        self.backlog = wanted - granted
+
+        for volId in todo:
+            volume = seen[volId]
+            # root devices are remembered as skipped, errors are retried
+            ebsInfo = None
+            if (not is_root_device(volume)):
+                ebsInfo = get_volume_ebs_info(self.botoClient, self.cloudWatch,
+                                              volume, self.useAvg, self.lookback)
+                if (ebsInfo == None):
+                    # new and changed volumes go to the back of the queue,
+                    # stale ones keep their old metrics until the retry
+                    if (volId in self.pending):
+                        del self.pending[volId]
+                        self.pending[volId] = True
+                    continue
+            self.volumes[volId] = [volume_signature(volume), ebsInfo, now]
+            if (volId in self.pending):
+                del self.pending[volId]
+
+        self.results = []
+        for volId, entry in self.volumes.items():
+            if (entry[1] == None):
+                continue
+            advInfo, totalIops, savingsType, cost = \
+                analyze_volume(self.region, entry[1], self.useAvg)
+            self.results.append((entry[1], advInfo, totalIops, savingsType, cost))
+
+        self.reschedule(now, changed, len(inventory))
+        return True
+
+    #
+    # Adapts the refresh interval to how much the region changes and how
+    # many volumes it has.  Large, volatile regions are refreshed more often
+    # and quiet ones less often.  Regions with pending or postponed metric
+    # queries are refreshed as soon as allowed to drain the backlog.
+    #
+    def reschedule(self, now, changed, numVols):
+        fraction = float(changed) / max(1, numVols)
+        self.changeRate = (1 - FC_DAEMON_CHANGE_WEIGHT) * self.changeRate + \
+                          FC_DAEMON_CHANGE_WEIGHT * fraction
+        interval = FC_DAEMON_MAX_INTERVAL / \
+                   ((1 + 20 * self.changeRate) * (1 + math.log10(1 + numVols)))
+        interval = max(FC_DAEMON_MIN_INTERVAL, min(FC_DAEMON_MAX_INTERVAL, interval))
+        if (len(self.pending) > 0 or self.backlog > 0):
+            interval = FC_DAEMON_MIN_INTERVAL
+        self.interval = int(interval)
+        self.nextRefresh = now + self.interval
+
+#
+# Builds a summary across all region models and prints it.  If server is
+# given, the advisories of all regions are published to it as well.
+#
+def publish_daemon_summary(models, refreshed, useJson, server=None):
+    summary = new_summary()
+    advisories = []
+    pending = 0
+    for model in models.values():
+        pending += len(model.pending)
+        for vol, advInfo, totalIops, savingsType, cost in model.results:
+            update_summary(summary, vol, advInfo, savingsType, cost)
+            if (advInfo != None):
+                advisories.append(advInfo)
+
+    if (server != None):
+        server.publish(advisories, summary)
+
+    currTime = arrow.now(FC_TIME_ZONE).format(TIME_FMT)
+    if (useJson == True):
+        schedule = {}
+        for r, model in models.items():
+            schedule[r] = {'Interval': model.interval,
+                           'NextRefresh': arrow.get(model.nextRefresh).to(FC_TIME_ZONE).format(TIME_FMT),
+                           'PendingVolumes': len(model.pending)}
+        dump_advisory_json({'Summary': summary,
+                            'Time': currTime,
+                            'Refreshed': refreshed,
+                            'Schedule': schedule})
+    else:
+        print("EBS summary at %s (refreshed %s, %d volumes pending metrics)"
+              %(currTime, refreshed, pending))
+        print_summary(summary)
+    sys.stdout.flush()
+
+#
+# Runs continuously, refreshing each region on its own adaptive schedule
+# and publishing an updated summary after every refresh.  If server is
+# given, the summary and advisories are published to it as well.
+#
+def run_daemon(access, secret, rList, useAvg, useJson, server=None,
+               lookback=FC_STAT_DAYS):
+    models = {}
+    limiter = MetricRateLimiter(FC_DAEMON_METRIC_RATE)
+    for r in rList:
+        clients = get_region_clients(access, secret, r)
+        if (clients == None):
+            return
+        models[r] = RegionModel(r, clients, useAvg, lookback)
+
+    # heap of (next refresh time, region)
+    schedule = [(0, r) for r in rList]
+    heapq.heapify(schedule)
+    try:
+        while True:
+            due, r = heapq.heappop(schedule)
+            now = time.time()
+            if (due > now):
+                time.sleep(due - now)
+            now = time.time()
+            if (models[r].refresh(now, limiter) == True):
+                publish_daemon_summary(models, r, useJson, server)
+            heapq.heappush(schedule, (models[r].nextRefresh, r))
+    except KeyboardInterrupt:
+        print("Daemon stopped.")
+
+#
+# Returns the stratum of an attached volume for sampling: region, type and
+# size bucket.
+#
+def sample_stratum(r, volume):
+    bucket = 0
+    for i in range(len(FC_SAMPLE_SIZE_BUCKETS)):
+        if (volume['Size'] >= FC_SAMPLE_SIZE_BUCKETS[i]):
+            bucket = i
+    return (r, volume['VolumeType'], FC_SAMPLE_SIZE_BUCKETS[bucket])
+
+#
+# Running count, sum and sum of squares of per-volume savings in a stratum.
+#
+class StratumStats(object):
+    def __init__(self, population):
+        self.population = population
+        self.n = 0
+        self.sums = {'ebsmotion': 0.0, 'capacity': 0.0, 'total': 0.0}
+        self.squares = {'ebsmotion': 0.0, 'capacity': 0.0, 'total': 0.0}
+
+    def add(self, savingsType, cost):
+        values = {'ebsmotion': 0.0, 'capacity': 0.0}
+        values[savingsType] = cost
+        values['total'] = cost
+        self.n += 1
+        for k, v in values.items():
+            self.sums[k] += v
+            self.squares[k] += v * v
+
+    #
+    # Returns the estimated total of savings type k over the whole stratum
+    # and the variance of that estimate.
+    #
+    def estimate(self, k):
+        N = self.population
+        n = self.n
+        mean = self.sums[k] / n
+        if (n < 2):
+            return N * mean, 0.0
+        s2 = max(0.0, (self.squares[k] - n * mean * mean) / (n - 1))
+        return N * mean, N * N * (1 - float(n) / N) * s2 / n
+
+#
+# Orders the attached volumes of all strata for sampling.  The first
+# FC_SAMPLE_MIN_PER_STRATUM volumes of every stratum come first, then the
+# rest interleaved proportionally to stratum size, so that stopping at any
+# point leaves a stratified sample.  Only the first
+# max(FC_SAMPLE_MIN_PER_STRATUM, ceil(rate * N)) volumes of a stratum of N
+# volumes are included, or all of them if N is smaller.
+#
+def sample_order(strata, rate):
+    order = []
+    for key, volumes in strata.items():
+        random.shuffle(volumes)
+        N = len(volumes)
+        n = min(N, max(FC_SAMPLE_MIN_PER_STRATUM, int(math.ceil(rate * N))))
+        for i in range(n):
+            if (i < FC_SAMPLE_MIN_PER_STRATUM):
+                priority = -1.0
+            else:
+                priority = (i + random.random()) / N
+            order.append((priority, key, volumes[i]))
+    order.sort(key=lambda o: o[0])
+    return [(key, volume) for priority, key, volume in order]
+
+#
+# Estimates savings from a stratified sample of attached volumes.  The full
+# inventory is taken with describe_volumes and unattached volumes are
+# analyzed exactly, since they need no CloudWatch data.  Attached volumes
+# are stratified by region, type and size bucket, and CloudWatch metrics are
+# only fetched for a sample of them, until either sampleRate of every
+# stratum is done or timeBudget seconds have passed.  Migration and
+# capacity savings are then extrapolated with confidence intervals.  If
+# snapshots is True, unattached volumes are priced as in analyze_ebs_motion.
+# If server is given, the advisories found and the summary are published
+# to it.
+#
+def analyze_sample(access, secret, rList, useAvg, useJson, sampleRate=1.0,
+                   timeBudget=0, lookback=FC_STAT_DAYS, snapshots=False, server=None):
+    deadline = time.time() + timeBudget if timeBudget > 0 else None
+    json_advisory = {"Migration": [], "Unattached": []}
+    advisories = []
+    summary = new_summary()
+
+    # region -> clients, stratum -> list of volumes
+    clients = {}
+    strata = {}
+    regionSizes = {}
+    for r in rList:
+        clients[r] = get_region_clients(access, secret, r)
+        if (clients[r] == None):
+            return
+        botoSession, botoClient, cloudWatch = clients[r]
+
+        inventory = describe_all_volumes(botoClient)
+        if (inventory == None):
+            continue
+        regionSizes[r] = len(inventory)
+
+        snapIndex = None
+        if (snapshots == True):
+            snapIndex = get_snapshot_index(botoClient)
+
+        for volume in inventory:
+            if (is_root_device(volume)):
+                continue
+            if (volume.get('Attachments')):
+                strata.setdefault(sample_stratum(r, volume), []).append(volume)
+                continue
+
+            # unattached volumes are exact and need no metrics
+            vol = get_volume_ebs_info(botoClient, None, volume, useAvg, lookback)
+            if (vol == None):
+                continue
+            advInfo, totalIops, savingsType, cost = analyze_volume(r, vol, useAvg)
+            update_summary(summary, vol, advInfo, savingsType, cost)
+            if (advInfo == None):
+                continue
+            if (snapIndex != None):
+                net = price_unattached_snapshot(r, advInfo, snapIndex.get(vol.VolId))
+                summary['unattached_net_savings'] = \
+                    summary.get('unattached_net_savings', 0) + net
+            advisories.append(advInfo)
+            if (useJson == True):
+                json_advisory['Unattached'].append(advInfo)
+            else:
+                print_advisory(advInfo, totalIops, lookback)
+
+    record_region_sizes(access, regionSizes)
+
+    # capacity of attached volumes is counted from the inventory
+    stats = {}
+    for key, volumes in strata.items():
+        stats[key] = StratumStats(len(volumes))
+        for volume in volumes:
+            summary.setdefault(volume['VolumeType'], {'count': 0, 'size': 0})
+            summary[volume['VolumeType']]['count'] += 1
+            summary[volume['VolumeType']]['size'] += volume['Size']
+            summary['total_capacity'] += volume['Size']
+
+    for key, volume in sample_order(strata, sampleRate):
+        if (deadline != None and time.time() >= deadline):
+            break
+        botoSession, botoClient, cloudWatch = clients[key[0]]
+        # volumes that still fail are dropped from the sample
+        vol = get_volume_ebs_info(botoClient, cloudWatch, volume, useAvg, lookback)
+        if (vol == None):
+            continue
+        advInfo, totalIops, savingsType, cost = analyze_volume(key[0], vol, useAvg)
+        stats[key].add(savingsType, cost)
+        if (advInfo == None):
+            continue
+        summary['num_advisories'] += 1
+        advisories.append(advInfo)
+        if (useJson == True):
+            json_advisory['Migration'].append(advInfo)
+        else:
+            print_advisory(advInfo, totalIops, lookback)
+
+    # extrapolate per stratum and add up estimates and variances
+    estimate = {'population': 0, 'sampled': 0, 'unsampled': 0,
+                'confidence': FC_SAMPLE_CONFIDENCE}
+    totals = {'ebsmotion': [0.0, 0.0], 'capacity': [0.0, 0.0], 'total': [0.0, 0.0]}
+    for key, s in stats.items():
+        estimate['population'] += s.population
+        if (s.n == 0):
+            estimate['unsampled'] += s.population
+            continue
+        estimate['sampled'] += s.n
+        for k in totals.keys():
+            est, var = s.estimate(k)
+            totals[k][0] += est
+            totals[k][1] += var
+
+    for k in totals.keys():
+        est, var = totals[k]
+        margin = FC_SAMPLE_Z * math.sqrt(var)
+        if (k != 'total'):
+            summary[k + '_savings'] = est
+        estimate[k + '_savings'] = est
+        estimate[k + '_savings_ci'] = [max(0.0, est - margin), est + margin]
+    summary['total_savings'] = summary['unattached_savings'] + totals['total'][0]
+    estimate['total_savings'] = summary['total_savings']
+    estimate['total_savings_ci'] = [summary['unattached_savings'] + v
+                                    for v in estimate['total_savings_ci']]
+
+    if (useJson == False):
+        print_summary(summary)
+        print("Sampled %s of %s attached volumes (%s in strata without samples)."
+              %("{:,}".format(estimate['sampled']),
+                "{:,}".format(estimate['population']),
+                "{:,}".format(estimate['unsampled'])))
+        print("%d%% confidence intervals of estimated monthly cost savings:"
+              %(int(FC_SAMPLE_CONFIDENCE * 100)))
+        for k, name in [('ebsmotion', "Migration/Type Switching:"),
+                        ('capacity', "Capacity Rightsizing (up to 50%):"),
+                        ('total', "Total Savings:")]:
+            lo, hi = estimate[k + '_savings_ci']
+            print("\t%-37s$%s - $%s" %(name, "{:,.2f}".format(lo), "{:,.2f}".format(hi)))
     else:
         dump_advisory_json({'Advisories': json_advisory})
         dump_advisory_json({'Summary': summary})
+        dump_advisory_json({'Estimate': estimate})
+
+    if (server != None):
+        server.publish(advisories, summary)
+
+#
+# Reads the whole region cache file, which holds one entry per access key.
+# Returns an empty cache if the file does not exist or cannot be parsed.
+#
+def read_region_cache_file():
+    try:
+        with open(FC_REGION_CACHE, "r") as f:
+            cache = json.load(f)
+        if (type(cache) == type({})):
+            return cache
+    except:
+        pass
+    return {}
+
+#
+# Returns the region cache entry of an access key, or an empty entry.
+# Accounts can have different regions enabled, so entries are never
+# shared between credentials.
+#
+def read_region_cache(access):
+    entry = read_region_cache_file().get(access)
+    if (type(entry) == type({})):
+        return entry
+    return {}
+
+def write_region_cache(access, entry):
+    cache = read_region_cache_file()
+    cache[access] = entry
+    try:
+        with open(FC_REGION_CACHE, "w") as f:
+            json.dump(cache, f)
+    except:
+        e = sys.exc_info()
+        print("Failed to write region cache %s: %s" %(FC_REGION_CACHE, str(e)))
+
+#
+# Remembers the number of volumes found in each region, so that the next
+# preflight can order regions largest-first.
+#
+def record_region_sizes(access, sizes):
+    cache = read_region_cache(access)
+    cache.setdefault('Sizes', {}).update(sizes)
+    write_region_cache(access, cache)
+
+#
+# Returns the list of regions enabled for the account, using a single
+# describe_regions call cached per access key for FC_REGION_CACHE_TTL
+# seconds.  Returns None if describe_regions fails, e.g. without the
+# ec2:DescribeRegions permission.
+#
+def get_enabled_regions(access, secret):
+    cache = read_region_cache(access)
+    if ('Regions' in cache and
+        time.time() - cache.get('Time', 0) < FC_REGION_CACHE_TTL):
+        return cache['Regions']
+
+    try:
+        botoClient = boto3.client('ec2', aws_access_key_id=access, aws_secret_access_key=secret, region_name=FC_DEFAULT_REGION)
+        response = botoClient.describe_regions()
+    except botocore.exceptions.ClientError as e:
+        print("Failed to describe regions: %s" %(e.response['Error']['Message']))
+        return None
+    except:
+        e = sys.exc_info()
+        print("Failed to describe regions: %s" %(str(e)))
+        return None
+
+    cache['Regions'] = sorted([region['RegionName'] for region in response['Regions']])
+    cache['Time'] = time.time()
+    write_region_cache(access, cache)
+    return cache['Regions']
+
+#
+# Probes a region with a cheap describe_volumes call and stores the number
+# of volumes seen in probes[r]: 0 for an empty region, up to
+# FC_PROBE_MAX_RESULTS + 1 if there are more, or -1 on error.  Runs in its
+# own thread, so botoClient must be created beforehand: creating clients
+# from several threads at once is not thread-safe in boto3.
+#
+def probe_region(botoClient, r, probes):
+    try:
+        response = botoClient.describe_volumes(MaxResults=FC_PROBE_MAX_RESULTS)
+        probes[r] = len(response['Volumes'])
+        if ('NextToken' in response and response['NextToken']):
+            probes[r] += 1
+    except botocore.exceptions.ClientError as e:
+        print("Failed to probe region %s: %s" %(r, e.response['Error']['Message']))
+        probes[r] = -1
+    except:
+        e = sys.exc_info()
+        print("Failed to probe region %s: %s" %(r, str(e)))
+        probes[r] = -1
+
+#
+# Preflight for the main scan.  Drops regions that are not enabled for the
+# account, probes the remaining ones concurrently and returns the regions
+# that have volumes, largest first.  Regions that could not be probed are
+# kept.  If rList is empty, all enabled regions are considered, or
+# aws_regions if the enabled regions cannot be retrieved.  If
+# keepEmpty is True, empty regions are kept as well, e.g. for daemon mode,
+# which refreshes them on its own slow schedule in case volumes appear.
+#
+def preflight_regions(access, secret, rList, useJson, keepEmpty=False):
+    enabled = get_enabled_regions(access, secret)
+    if (enabled == None):
+        # enabled regions unknown, keep an explicit -r list as given
+        if (len(rList) == 0):
+            rList = aws_regions
+    elif (len(rList) == 0):
+        rList = enabled
+    else:
+        for r in rList:
+            if (r not in enabled):
+                if (useJson == False):
+                    print("Skipping region %s: not enabled" %(r))
+        rList = [r for r in rList if r in enabled]
+
+    probes = {}
+    clients = {}
+    for r in rList:
+        try:
+            clients[r] = boto3.client('ec2', aws_access_key_id=access, aws_secret_access_key=secret, region_name=r)
+        except:
+            e = sys.exc_info()
+            print("Failed to probe region %s: %s" %(r, str(e)))
+            probes[r] = -1
+
+    threads = []
+    for r, botoClient in clients.items():
+        thread = threading.Thread(target=probe_region, args=(botoClient, r, probes))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    empty = []
+    if (keepEmpty == False):
+        empty = [r for r in rList if probes.get(r, -1) == 0]
+    if (useJson == False and len(empty) > 0):
+        print("Skipping %d regions without volumes: %s\n" %(len(empty), ",".join(empty)))
+
+    # order by the size seen in the last scan or by the probe if larger
+    sizes = read_region_cache(access).get('Sizes', {})
+    regions = [r for r in rList if r not in empty]
+    regions.sort(key=lambda r: max(sizes.get(r, 0), probes.get(r, -1)), reverse=True)
+    return regions
 
 def print_usage():
      print("EbsCostAdvisor.py <options>\n"
@@ -782,8 +2241,24 @@ def print_usage():
            "\t-a --accesskey <access key> - AWS access key\n"
            "\t-s --secretkey <secret key> - AWS secret key\n"
            "\t-r --regions <region1,region2,...> - A list of AWS regions.  If this option is omitted, all regions will be checked.\n"
+           "\t-P --no-preflight - Do not discover enabled regions and skip empty ones before the scan.  Uses a built-in region list if -r is omitted.\n"
            "\t-m --mean - Use average (mean) values instead of maximum values for metrics used to determine advisories.\n"
-           "\t-j --json - Output in JSON format.\n\n"
+           "\t-j --json - Output in JSON format.\n"
+           "\t-d --daemon - Run continuously, refreshing each region on an adaptive schedule and printing an updated summary after each refresh.\n"
+           "\t-l --lookback <days> - Number of days of metrics to analyze (default " + str(FC_STAT_DAYS) + ", maximum " + str(FC_MAX_STAT_DAYS) + ").  Older days are retrieved at a coarser resolution.\n"
+           "\t-R --sample-rate <fraction> - Only fetch metrics for this fraction of the attached volumes, stratified by region, type and size,\n"
+           "\t\tand extrapolate migration and capacity savings with confidence intervals.  Unattached volumes are analyzed exactly.\n"
+           "\t-T --time-budget <seconds> - Like -R, but sample attached volumes until the time budget is spent.  Can be combined with -R.\n"
+           "\t-t --top <K> - Only output the K advisories with the highest monthly cost savings.  The summary still covers all volumes.\n"
+           "\t-b --top-by <all|region|type> - Keep the top K advisories overall (default) or per region or volume type.\n"
+           "\t-g --group-by <rollup1,rollup2,...> - Also output cost and savings grouped by each rollup.  A rollup is one or more of\n"
+           "\t\ttag:<key>, instance, az, region, type and account joined with '+', e.g. tag:team,tag:env+az.\n"
+           "\t-n --snapshots - Look up existing snapshots of unattached volumes with one describe_snapshots sweep per region and\n"
+           "\t\testimate their savings net of snapshot storage.\n"
+           "\t-S --serve <[host:]port> - Serve the latest advisories over a read-only HTTP query service (localhost if no host is given).\n"
+           "\t\tGET /summary returns the summary.  GET /advisories accepts the region, type, instance, status, tag (Key=Value) and\n"
+           "\t\tbucket filters (repeat a filter to match any of its values), min_savings, max_savings, sort (MonthlyCostSavings, VolId, Region,\n"
+           "\t\tType, Ec2Id, Size, Iops or CreateTime), order (asc or desc), offset and limit.\n\n"
            "\tOne of the following three parameters are required:\n"
            "\t\t1. Both the -a and -s options.\n"
            "\t\t2. The -p option.\n"
@@ -798,14 +2273,25 @@ def parse_options(argv):
     parser.add_argument("-a", "--access-key", type=str, required=False)
     parser.add_argument("-s", "--secret-key", type=str, required=False)
     parser.add_argument("-r", "--regions", type=str, default="")
+    parser.add_argument("-P", "--no-preflight", action="store_true", default=False)
     parser.add_argument("-m", "--mean", action="store_true", default=False)
     parser.add_argument("-j", "--json", action="store_true", default=False)
+    parser.add_argument("-d", "--daemon", action="store_true", default=False)
+    parser.add_argument("-S", "--serve", type=str, default="")
+    parser.add_argument("-g", "--group-by", type=str, default="")
+    parser.add_argument("-n", "--snapshots", action="store_true", default=False)
+    parser.add_argument("-l", "--lookback", type=int, default=FC_STAT_DAYS)
+    parser.add_argument("-R", "--sample-rate", type=float, default=0)
+    parser.add_argument("-T", "--time-budget", type=int, default=0)
+    parser.add_argument("-t", "--top", type=int, default=0)
+    parser.add_argument("-b", "--top-by", type=str, default="all",
+                        choices=['all', 'region', 'type'])
 
     args = parser.parse_args(argv)
     if (len(args.regions) == 0):
-        return args.profile, args.access_key, args.secret_key, [], args.mean, args.json
+        return args.profile, args.access_key, args.secret_key, [], args.mean, args.json, args
     else:
-        return args.profile, args.access_key, args.secret_key, args.regions.split(','), args.mean, args.json
+        return args.profile, args.access_key, args.secret_key, args.regions.split(','), args.mean, args.json, args
 
 def parse_args(argv):
     # ArgumentParser's built-in way of automatically handling -h and --help
@@ -815,12 +2301,13 @@ def parse_args(argv):
             print_usage()
             os._exit(0)
 
-    p, a, s, rList, m, j = parse_options(argv[1:])
+    # opts holds the remaining options, such as opts.daemon
+    p, a, s, rList, m, j, opts = parse_options(argv[1:])
 
-    return p, a, s, rList, m, j
+    return p, a, s, rList, m, j, opts
 
 if __name__ == "__main__":
-    p, a, s, rList, m, j = parse_args(sys.argv)
+    p, a, s, rList, m, j, opts = parse_args(sys.argv)
 
     # need either -a and -s, -p, or AWS_DEFAULT_PROFILE environment variable
     if not a and not s and not p:
@@ -862,6 +2349,81 @@ if __name__ == "__main__":
             print("Error reading credentials for profile %s." %p)
             os._exit(1)
 
-    if (len(rList) == 0):
+    if (opts.lookback < FC_STAT_DAYS or opts.lookback > FC_MAX_STAT_DAYS):
+        print_usage()
+        print("\nError: lookback must be between %d and %d days" %(FC_STAT_DAYS, FC_MAX_STAT_DAYS))
+        os._exit(1)
+
+    if (opts.sample_rate < 0 or opts.sample_rate > 1 or opts.time_budget < 0):
+        print_usage()
+        print("\nError: sample rate must be between 0 and 1 and time budget must not be negative")
+        os._exit(1)
+
+    if (opts.daemon == True and opts.snapshots == True):
+        print_usage()
+        print("\nError: -n cannot be combined with -d")
+        os._exit(1)
+
+    if (opts.daemon == True and opts.top > 0):
+        print_usage()
+        print("\nError: -t cannot be combined with -d")
+        os._exit(1)
+
+    if (opts.daemon == True and (opts.sample_rate > 0 or opts.time_budget > 0)):
+        print_usage()
+        print("\nError: -R and -T cannot be combined with -d")
+        os._exit(1)
+
+    if ((opts.sample_rate > 0 or opts.time_budget > 0) and opts.top > 0):
+        print_usage()
+        print("\nError: -t cannot be combined with -R or -T")
+        os._exit(1)
+
+    rollupSpecs = [spec for spec in opts.group_by.split(',') if spec]
+    if (len(rollupSpecs) > 0 and
+        (opts.daemon == True or opts.sample_rate > 0 or opts.time_budget > 0)):
+        print_usage()
+        print("\nError: -g cannot be combined with -d, -R or -T")
+        os._exit(1)
+
+    for spec in rollupSpecs:
+        error = Rollup.validate(spec)
+        if (error != None):
+            print_usage()
+            print("\nError: %s" %(error))
+            os._exit(1)
+
+    if (opts.no_preflight == False):
+        rList = preflight_regions(a, s, rList, j, opts.daemon)
+    elif (len(rList) == 0):
         rList = aws_regions
-    analyze_ebs_motion(a, s, rList, m, j)
+
+    server = None
+    if (len(opts.serve) > 0):
+        server = start_server(opts.serve)
+        if (server == None):
+            os._exit(1)
+
+    if (opts.daemon == True):
+        run_daemon(a, s, rList, m, j, server, opts.lookback)
+    else:
+        if (opts.sample_rate > 0 or opts.time_budget > 0):
+            analyze_sample(a, s, rList, m, j, opts.sample_rate or 1.0,
+                           opts.time_budget, opts.lookback, opts.snapshots, server)
+        else:
+            top = None
+            if (opts.top > 0):
+                top = TopAdvisories(opts.top, opts.top_by)
+            account = ""
+            if ('account' in "+".join(rollupSpecs).split('+')):
+                account = get_account_id(a, s)
+            rollups = [Rollup(spec, account) for spec in rollupSpecs]
+            analyze_ebs_motion(a, s, rList, m, j, server, top, opts.lookback, rollups,
+                               opts.snapshots)
+        # keep serving the results until interrupted
+        if (server != None):
+            try:
+                while True:
+                    time.sleep(3600)
+            except KeyboardInterrupt:
+                sys.stderr.write("Query service stopped.\n")